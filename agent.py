@@ -1,11 +1,20 @@
 import os
+import copy
+import asyncio
 import logging
 import time
+import weakref
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import re
 import html
 
-from rag import Rag
+from rag import Rag, BM25Index
+from project import batch_texts, iter_confluence_tree, iter_modules, iter_source_files
+from replay import SessionRecorder, token_usage, usage_cost
+from prompts import build_messages, compact, prefix_session
 from langchain_gigachat.chat_models import GigaChat
 from requests.auth import HTTPBasicAuth
 from langchain.tools import tool
@@ -13,6 +22,8 @@ from langchain.agents import initialize_agent
 from langchain.agents import AgentType
 from jira import JIRA 
 from bs4 import BeautifulSoup as soup
+from langchain_core.documents import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 from urllib.parse import urlparse
 
 credentials = os.environ.get("GIGACHAT_API_KEY")
@@ -47,9 +58,181 @@ gigachat_model = GigaChat(
 )
 
 
+# === Чтение страниц Confluence ===
+confluence_api_url = "https://kpaqkpaq.atlassian.net/wiki/rest/api/content"
+
+
+def load_confluence_page(page_id):
+    """
+    Загружает страницу Confluence и возвращает ее текст без разметки.
+
+    page_id: идентификатор страницы.
+    return: текст страницы.
+    raise: requests.HTTPError, если Confluence вернул ошибку.
+    """
+    base_url = f"{confluence_api_url}/{page_id}?expand=body.storage"
+    response = requests.get(base_url, auth=HTTPBasicAuth(login, password))
+    response.raise_for_status()
+    data = response.json()
+    return soup(data['body']['storage']['value'], 'html.parser').get_text(separator="\n", strip=True)
+
+
+def list_confluence_children(page_id):
+    """
+    Возвращает дочерние страницы Confluence.
+
+    page_id: идентификатор страницы.
+    return: список пар (идентификатор, заголовок).
+    raise: requests.HTTPError, если Confluence вернул ошибку.
+    """
+    children = []
+    url = f"{confluence_api_url}/{page_id}/child/page?limit=100"
+    while url:
+        response = requests.get(url, auth=HTTPBasicAuth(login, password))
+        response.raise_for_status()
+        data = response.json()
+        children.extend((child["id"], child["title"]) for child in data["results"])
+        links = data.get("_links", {})
+        next_link = links.get("next")
+        base = links.get("base") or confluence_api_url.split("/rest/api")[0]
+        url = f"{base}{next_link}" if next_link else None
+    return children
+
+
+# === Ограничение числа одновременных запросов к модели ===
+# Общий лимит для всех агентов и всех запусков в процессе
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 8))
+_llm_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_llm_semaphore():
+    """
+    Возвращает глобальный семафор запросов к модели для текущего event loop.
+
+    asyncio.Semaphore привязан к event loop, поэтому для каждого loop создается свой.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _llm_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+        _llm_semaphores[loop] = semaphore
+    return semaphore
+
+
+# === Маршрутизация агентов по уровням моделей ===
+# Уровни моделей от самой дешевой к самой сильной
+MODEL_TIERS = {
+    "lite": "GigaChat",
+    "pro": "GigaChat-Pro",
+    "max": "GigaChat-Max",
+}
+TIER_ORDER = list(MODEL_TIERS)
+
+# Уровень модели для каждого этапа: классификаторы и проверки ввода - легкая модель, анализ - Max
+STAGE_TIERS = {
+    "boss_agent": "lite",
+    "wish_checker": "lite",
+    "anwer_tool_checker": "lite",
+    "req_checker": "lite",
+    "code_checker": "lite",
+    "req_analyzer": "max",
+    "alignment_checker": "max",
+    "coder": "max",
+    "two_code_analyzer": "max",
+    "report_generator": "max",
+    "quality_evaluator": "pro",
+    "summarizer_agent": "pro",
+}
+
+
+def _create_gigachat(model, temperature, top_p):
+    return GigaChat(
+        credentials=credentials,
+        verify_ssl_certs=False,
+        timeout=360,
+        temperature=temperature,
+        top_p=top_p,
+        model=model
+    )
+
+
+class ModelRouter:
+    def __init__(self, tiers=MODEL_TIERS, factory=_create_gigachat):
+        """
+        Выдает модели по уровню и параметрам генерации, одна модель переиспользуется всеми агентами и запусками.
+
+        tiers: соответствие уровня и названия модели.
+        factory: функция создания модели (название, temperature, top_p).
+        """
+        self.tiers = tiers
+        self.factory = factory
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, tier, temperature=0.2, top_p=0.5):
+        key = (self.tiers[tier], temperature, top_p)
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = self.factory(*key)
+            return self._models[key]
+
+    def escalation(self, tier, temperature=0.2, top_p=0.5):
+        """Модели более высоких уровней, на которые повторяется запрос при неверном формате ответа."""
+        higher = TIER_ORDER[TIER_ORDER.index(tier) + 1:]
+        return [self.get(name, temperature, top_p) for name in higher]
+
+
+model_router = ModelRouter()
+
+
+class StageStats:
+    def __init__(self):
+        """
+        Задержка, токены и стоимость запросов к модели по этапам.
+
+        Задержка запроса учитывается по всем попыткам, включая неудачные, таймауты и паузы между повторами,
+        failures - количество неудачных попыток.
+        """
+        self._lock = threading.Lock()
+        self.stages = defaultdict(lambda: {
+            "calls": 0, "failures": 0, "escalations": 0, "latency": 0.0, "input_tokens": 0, "output_tokens": 0,
+            "cost": 0.0, "models": [],
+        })
+
+    def record(self, stage, model, latency, usage, failures=0):
+        with self._lock:
+            stats = self.stages[stage]
+            stats["calls"] += 1
+            stats["failures"] += failures
+            stats["latency"] += latency
+            stats["input_tokens"] += usage.get("input_tokens", 0)
+            stats["output_tokens"] += usage.get("output_tokens", 0)
+            stats["cost"] += usage_cost(model, usage)
+            if model not in stats["models"]:
+                stats["models"].append(model)
+
+    def record_escalation(self, stage):
+        with self._lock:
+            self.stages[stage]["escalations"] += 1
+
+    def summary(self):
+        with self._lock:
+            return {stage: dict(stats, models=list(stats["models"])) for stage, stats in self.stages.items()}
+
+    def report(self):
+        """Таблица по этапам в текстовом виде."""
+        lines = [f"{'Этап':<36}{'модели':<28}{'вызовов':>8}{'ошибок':>7}{'эскал.':>7}{'задержка, с':>13}{'стоимость, ₽':>14}"]
+        for stage, stats in self.summary().items():
+            models = ", ".join(str(model) for model in stats["models"])
+            lines.append(f"{stage:<36}{models:<28}{stats['calls']:>8}{stats['failures']:>7}{stats['escalations']:>7}"
+                         f"{stats['latency']:>13.2f}{stats['cost']:>14.2f}")
+        return "\n".join(lines)
+
+
 # Класс агента
 class Agent:
-    def __init__(self, role_description, model, max_retries=10, name=None, memory=None):
+    def __init__(self, role_description, model, max_retries=10, name=None, memory=None, timeout=None, retry_delay=20,
+                 recorder=None, escalation=None, format_check=None, stats=None):
         """
         Инициализация агента.
 
@@ -58,62 +241,266 @@ class Agent:
         max_retries: Максимальное количество повторов в случае ошибки.
         name: Имя агента.
         memory: Объект памяти для хранения промежуточных результатов.
+        timeout: Таймаут одного асинхронного запроса к модели в секундах (None - без таймаута).
+        retry_delay: Пауза между повторами в секундах.
+        recorder: Запись или воспроизведение запросов к модели (см. replay.py).
+        escalation: Более сильные модели, на которых повторяется запрос, если ответ не прошел format_check.
+        format_check: Функция проверки формата ответа, возвращает True для корректного ответа.
+        stats: Объект StageStats для учета задержки и стоимости.
         """
         self.role_description = role_description
+        # Стабильный префикс всех запросов агента
+        self.system_prompt = compact(role_description)
         self.model = model
         self.max_retries = max_retries
         self.name = name or "Agent"
         self.memory = memory
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.recorder = recorder
+        self.escalation = escalation or []
+        self.format_check = format_check
+        self.stats = stats
 
-    def run(self, input_text, memory_key_read=None, memory_key_write=None):
-        """
-        Выполнение запроса к модели с учетом контекста из памяти.
-
-        input_text: Текст запроса для модели.
-        memory_key_read: Ключ памяти, откуда брать контекст.
-        memory_key_write: Ключ памяти, куда записывать результат.
-        return: Ответ от модели или None в случае ошибки.
-        """
+    def _build_prompt(self, input_text, memory_key_read):
+        """Формирует сообщения: описание роли - системное сообщение, контекст из памяти и задание - сообщение пользователя."""
         # Получаем содержимое памяти, если указан ключ
         memory_content = ""
         if self.memory and memory_key_read:
-            mem = self.memory.read(memory_key_read)
-            if mem:
-                memory_content = f"\nКонтекст из памяти [{memory_key_read}]:\n{mem}\n"
+            memory_content = self.memory.read(memory_key_read)
         
-        # Формируем промпт с описанием роли и контекстом
-        prompt = f"{self.role_description}\n{memory_content}\n{input_text}"
+        return build_messages(self.system_prompt, input_text, memory_content, memory_key_read)
+
+    def _record_stats(self, model, latency, usage, failures):
+        if self.stats is not None:
+            self.stats.record(self.name, getattr(model, "model", None), latency, usage, failures)
+
+    def _handle_response(self, model, response, latency, failures):
+        """Извлекает текст ответа модели и учитывает задержку и стоимость запроса."""
+        self._record_stats(model, latency, token_usage(response), failures)
+        if hasattr(response, "content"):
+            return response.content.strip()
+        return response.strip()
+
+    def _accept(self, result, has_fallback):
+        """Принимает ответ или переходит к более сильной модели, если ответ не прошел проверку формата."""
+        if result is None or self.format_check is None or self.format_check(result) or not has_fallback:
+            return True
+        logging.warning(f"Ответ агента '{self.name}' не прошел проверку формата, запрос повторяется на более сильной модели")
+        if self.stats is not None:
+            self.stats.record_escalation(self.name)
+        return False
+
+    def _write_memory(self, result, memory_key_write):
+        # Записываем результат в память, если указан ключ для записи
+        if result is not None and self.memory and memory_key_write:
+            self.memory.append(memory_key_write, f"{self.name}:\n{result}")
+        return result
+
+    def _invoke(self, model, prompt):
+        if self.recorder is None:
+            return model.invoke(prompt)
+        return self.recorder.invoke(self.name, model, prompt)
+
+    def _ainvoke(self, model, prompt):
+        if self.recorder is None:
+            return model.ainvoke(prompt)
+        return self.recorder.ainvoke(self.name, model, prompt)
+
+    def _call_model(self, model, prompt):
+        # Задержка считается по всем попыткам, включая неудачные и паузы между ними
+        start = time.perf_counter()
         retries = 0
         while retries < self.max_retries:
             try:
-                response = self.model.invoke(prompt)
-                # Извлекаем ответ
-                if hasattr(response, "content"):
-                    result = response.content.strip()
-                else:
-                    result = response.strip()
-                # Записываем результат в память, если указан ключ для записи
-                if self.memory and memory_key_write:
-                    self.memory.append(memory_key_write, f"{self.name}:\n{result}")
-                return result
+                with prefix_session(self.system_prompt):
+                    response = self._invoke(model, prompt)
+                return self._handle_response(model, response, time.perf_counter() - start, retries)
             except Exception as e:
                 logging.error(f"Ошибка при вызове модели для агента '{self.name}': {e}")
                 retries += 1
-                time.sleep(20)
+                time.sleep(self.retry_delay)
                 if retries >= self.max_retries:
+                    self._record_stats(model, time.perf_counter() - start, {}, retries)
                     print(f"Ошибка: {str(e)}")
                     return None
 
+    async def _acall_model(self, model, prompt, timeout):
+        # Задержка считается по всем попыткам, включая таймауты, паузы между повторами и ожидание семафора
+        start = time.perf_counter()
+        retries = 0
+        while retries < self.max_retries:
+            try:
+                # Семафор занят только на время запроса, паузы между повторами его не держат
+                async with get_llm_semaphore():
+                    with prefix_session(self.system_prompt):
+                        response = await asyncio.wait_for(self._ainvoke(model, prompt), timeout)
+                return self._handle_response(model, response, time.perf_counter() - start, retries)
+            except Exception as e:
+                logging.error(f"Ошибка при вызове модели для агента '{self.name}': {e!r}")
+                retries += 1
+                if retries >= self.max_retries:
+                    self._record_stats(model, time.perf_counter() - start, {}, retries)
+                    print(f"Ошибка: {e!r}")
+                    return None
+                await asyncio.sleep(self.retry_delay)
+
+    def run(self, input_text, memory_key_read=None, memory_key_write=None):
+        """
+        Выполнение запроса к модели с учетом контекста из памяти.
+
+        Если ответ не прошел проверку формата, запрос повторяется на моделях из escalation.
+
+        input_text: Текст запроса для модели.
+        memory_key_read: Ключ памяти, откуда брать контекст.
+        memory_key_write: Ключ памяти, куда записывать результат.
+        return: Ответ от модели или None в случае ошибки.
+        """
+        prompt = self._build_prompt(input_text, memory_key_read)
+        models = [self.model, *self.escalation]
+        for position, model in enumerate(models):
+            result = self._call_model(model, prompt)
+            if self._accept(result, position + 1 < len(models)):
+                break
+        return self._write_memory(result, memory_key_write)
+
+    async def arun(self, input_text, memory_key_read=None, memory_key_write=None, timeout=None):
+        """
+        Асинхронное выполнение запроса к модели с учетом контекста из памяти.
+
+        Число одновременных запросов ограничено глобальным семафором (LLM_CONCURRENCY).
+        Отмена задачи (asyncio.CancelledError) не перехватывается и прерывает повторы.
+        Если ответ не прошел проверку формата, запрос повторяется на моделях из escalation.
+
+        input_text: Текст запроса для модели.
+        memory_key_read: Ключ памяти, откуда брать контекст.
+        memory_key_write: Ключ памяти, куда записывать результат.
+        timeout: Таймаут одного запроса в секундах, по умолчанию self.timeout.
+        return: Ответ от модели или None в случае ошибки.
+        """
+        prompt = self._build_prompt(input_text, memory_key_read)
+        timeout = self.timeout if timeout is None else timeout
+        models = [self.model, *self.escalation]
+        for position, model in enumerate(models):
+            result = await self._acall_model(model, prompt, timeout)
+            if self._accept(result, position + 1 < len(models)):
+                break
+        return self._write_memory(result, memory_key_write)
+
+
+# === Ранний (спекулятивный) запуск завершающих этапов ===
+# Этапы, которые можно запускать по результатам анализа, не дожидаясь подробного отчета
+SPECULATIVE_STAGES = ("quality_evaluator", "summarizer_agent")
+
+# Вызовы завершающих этапов по подробному отчету (обычный режим)
+FINAL_STAGE_CALLS = {
+    "quality_evaluator": dict(
+        input_text="Оцени соответствие требований и кода, выстави оценку по указанной шкале и дай короткий комментарий.",
+        memory_key_read="Оценка данных",
+        memory_key_write="Оценка качества",
+    ),
+    "summarizer_agent": dict(
+        input_text="Сформируй суммаризованный отчет по заданной структуре.",
+        memory_key_read="Полный отчет",
+        memory_key_write="Суммаризованный отчет",
+    ),
+}
+
+# Вызовы тех же этапов по результатам анализа, параллельно с подробным отчетом
+SPECULATIVE_STAGE_CALLS = {
+    "quality_evaluator": dict(FINAL_STAGE_CALLS["quality_evaluator"], memory_key_read="Информация по проекту"),
+    "summarizer_agent": dict(
+        FINAL_STAGE_CALLS["summarizer_agent"],
+        input_text="Сформируй суммаризованный отчет по заданной структуре. Раздел \"Оценка\" оставь пустым, он будет заполнен отдельно.",
+        memory_key_read="Информация по проекту",
+    ),
+}
+
+
+# Сверка раннего результата с подробным отчетом (reconcile=True): этап подтверждает или исправляет свой ответ
+RECONCILE_STAGE_CALLS = {
+    "quality_evaluator": dict(
+        FINAL_STAGE_CALLS["quality_evaluator"],
+        input_text=(
+            "Ниже предварительная оценка, выставленная по результатам анализа до подробного отчета. "
+            "Сверь ее с подробным отчетом: если оценки и комментарии согласуются с ним, повтори оценку без изменений, "
+            "иначе исправь ее. Выведи ответ строго в заданном формате.\n\nПредварительная оценка:\n{early}"
+        ),
+    ),
+    "summarizer_agent": dict(
+        FINAL_STAGE_CALLS["summarizer_agent"],
+        input_text=(
+            "Ниже предварительный краткий отчет, сформированный по результатам анализа до подробного отчета. "
+            "Сверь его с полным отчетом: если он согласуется с полным отчетом, повтори его без изменений, "
+            "иначе исправь или дополни его. Сохрани заданную структуру.\n\nПредварительный краткий отчет:\n{early}"
+        ),
+    ),
+}
+
+STAGE_MODES = ("final", "speculative")
+
+
+def check_stage_output(stage, text):
+    """
+    Проверяет формат ответа завершающего этапа.
+
+    stage: "quality_evaluator" или "summarizer_agent".
+    text: ответ агента.
+    return: True, если ответ соответствует ожидаемой структуре.
+    """
+    if not text:
+        return False
+    if stage == "quality_evaluator":
+        return bool(re.search(r"Оценка требований:\s*\d+", text) and re.search(r"Оценка кода:\s*\d+", text))
+    return "Ответ по требованиям" in text and "Отчет соответствия требований и кода" in text
+
+
+def merge_evaluation(summary, quality_evaluation):
+    """Подставляет оценку качества в раздел "Оценка" краткого отчета, сформированного заранее."""
+    if not summary:
+        return summary
+    position = summary.rfind("Оценка:")
+    head = summary[:position].rstrip() if position != -1 else summary.rstrip()
+    return f"{head}\n\nОценка:\n{quality_evaluation}"
+
+
+def parse_yes_no(text):
+    """
+    Разбирает ответ агента "Проверка желания".
+
+    text: ответ агента, например "Да." или "нет".
+    return: "да", "нет" или None, если ответ не в ожидаемом формате.
+    """
+    match = re.fullmatch(r"\W*(да|нет)\W*", (text or "").lower())
+    return match.group(1) if match else None
+
+
+# Проверки формата ответов: при неверном формате запрос повторяется на более сильной модели
+STAGE_FORMAT_CHECKS = {
+    "wish_checker": lambda text: any(word in text.lower() for word in ("ссылк", "файл", "ничего")),
+    "anwer_tool_checker": lambda text: parse_yes_no(text) is not None,
+    "req_checker": lambda text: "корректный ввод требований" in text.lower(),
+    "code_checker": lambda text: "корректный ввод кода" in text.lower(),
+    "quality_evaluator": lambda text: check_stage_output("quality_evaluator", text),
+    "summarizer_agent": lambda text: check_stage_output("summarizer_agent", text),
+}
+
 
 # === Определение класса памяти агентов ===
 class Memory:
     def __init__(self):
         self.data = {}
+        # Записи, уже добавленные по каждому ключу: повторный блок не дублируется в контексте
+        self.entries = {}
 
     def read(self, key):
         return self.data.get(key, "")
 
     def append(self, key, value):
+        entries = self.entries.setdefault(key, set())
+        if value in entries:
+            return
+        entries.add(value)
         if key in self.data:
             self.data[key] += f"\n{value}"
         else:
@@ -121,20 +508,54 @@ class Memory:
 
     def clear(self):
         self.data = {}
+        self.entries = {}
 
 
 class Main_Workflow:
-    def __init__(self, project_requirements='', project_code='', gigachat_model=gigachat_model):
+    default_model = gigachat_model
+
+    def __init__(self, project_requirements='', project_code='', gigachat_model=None,
+                 stage_modes=None, reconcile=False, recorder=None, router=None, stage_tiers=None, retry_delay=20):
         """
         Класс работы агентов.
 
         project_requirements: бизнес требование.
         project_code: код пользователя.
-        gigachat_model: модель для агентов.
+        gigachat_model: модель для всех агентов. Если не указана, модели выбираются по этапам через router.
+        stage_modes: режим завершающих этапов {"quality_evaluator" | "summarizer_agent": "final" | "speculative"}.
+                     "final" - этап запускается по подробному отчету (по умолчанию),
+                     "speculative" - по результатам анализа, параллельно с подробным отчетом.
+                     raise: ValueError для неизвестного этапа или режима.
+        reconcile: ранний ответ спекулятивного этапа сверяется с подробным отчетом: этап подтверждает или исправляет его.
+                   Без reconcile ранний ответ используется как есть.
+        recorder: запись сессии (SessionRecorder) или ее воспроизведение (ReplaySession).
+                  По умолчанию сессии записываются в директорию AGENT_RECORD_DIR, если она задана.
+        router: ModelRouter для выбора модели по этапу, по умолчанию model_router, если gigachat_model не указана.
+        stage_tiers: переопределение уровней моделей по этапам, например {"quality_evaluator": "max"}.
+        retry_delay: пауза между повторами запроса к модели в секундах.
         """
         self.project_requirements = project_requirements
         self.project_code = project_code
-        self.gigachat_model = gigachat_model
+        self.gigachat_model = gigachat_model if gigachat_model is not None else self.default_model
+        if router is None and gigachat_model is None:
+            router = model_router
+        self.router = router
+        self.stage_tiers = dict(STAGE_TIERS, **(stage_tiers or {}))
+        self.retry_delay = retry_delay
+        self.stats = StageStats()
+        self.stage_modes = {stage: "final" for stage in SPECULATIVE_STAGES}
+        for stage, mode in (stage_modes or {}).items():
+            if stage not in SPECULATIVE_STAGES:
+                raise ValueError(f"Режим задается только для этапов {', '.join(SPECULATIVE_STAGES)}: {stage}")
+            if mode not in STAGE_MODES:
+                raise ValueError(f"Неизвестный режим этапа {stage}: {mode}, допустимые: {', '.join(STAGE_MODES)}")
+            self.stage_modes[stage] = mode
+        self.reconcile = reconcile
+        if recorder is None and os.environ.get("AGENT_RECORD_DIR"):
+            # Директория создается заранее, иначе путь считается именем файла и сессии перезаписывают друг друга
+            os.makedirs(os.environ["AGENT_RECORD_DIR"], exist_ok=True)
+            recorder = SessionRecorder(os.environ["AGENT_RECORD_DIR"])
+        self.recorder = recorder
         
         
     def extract_id(self, url):
@@ -182,7 +603,7 @@ class Main_Workflow:
         comment: комментарий для публикации на confluence str
         """
         # URL для создания комментария
-        url = "https://kpaqkpaq.atlassian.net/wiki/rest/api/content"
+        url = confluence_api_url
         # Заголовки
         headers = {
             "Content-Type": "application/json"
@@ -210,6 +631,21 @@ class Main_Workflow:
 
         return "Комментарий оставлен!"
 
+    def _call(self, stage, func, request):
+        """Вызов внешнего источника данных с записью или воспроизведением, если задан recorder."""
+        if self.recorder is None:
+            return func(request)
+        return self.recorder.call(stage, func, request)
+
+    def load_page(self, page_id):
+        """
+        Загружает текст страницы Confluence.
+
+        page_id: идентификатор страницы.
+        return: текст страницы.
+        """
+        return self._call("Confluence", load_confluence_page, page_id)
+
     def data_read(self, answer_user_material):
         """
         Считывает бизнес требование и код по ссылке Confluenсe или из файла
@@ -223,31 +659,24 @@ class Main_Workflow:
             while flag:
                 link = input('Введите ссылку на требования:') 
                 PAGE_ID = self.extract_id(link)
-                base_url = f"https://kpaqkpaq.atlassian.net/wiki/rest/api/content/{PAGE_ID}?expand=body.storage"
-                auth = HTTPBasicAuth(login, password) 
                 if PAGE_ID is not None:
-                    response = requests.get(base_url, auth=auth)
-                    if response.status_code == 200:
-                        data = response.json()
-                        project_requirements = soup(data['body']['storage']['value'], 'html.parser').get_text(separator="\n", strip=True)
+                    try:
+                        project_requirements = self.load_page(PAGE_ID)
                         flag = False
-                    else:
-                        print("Ошибка:", response.status_code, response.text)
+                    except requests.HTTPError as e:
+                        print("Ошибка:", e.response.status_code, e.response.text)
                 else:
                     print('В предоставленной ссылке нет pageId.')
             flag = True
             while flag:
                 link = input('Введите ссылку на код:') 
                 PAGE_ID = self.extract_id(link)
-                base_url = f"https://kpaqkpaq.atlassian.net/wiki/rest/api/content/{PAGE_ID}?expand=body.storage"
                 if PAGE_ID is not None:
-                    response = requests.get(base_url, auth=auth)
-                    if response.status_code == 200:
-                        data = response.json()
-                        project_code = soup(data['body']['storage']['value'], 'html.parser').get_text(separator="\n", strip=True)
+                    try:
+                        project_code = self.load_page(PAGE_ID)
                         flag = False
-                    else:
-                        print("Ошибка:", response.status_code, response.text)
+                    except requests.HTTPError as e:
+                        print("Ошибка:", e.response.status_code, e.response.text)
                 else:
                     print('В предоставленной ссылке нет pageId.')
         else:
@@ -272,19 +701,36 @@ class Main_Workflow:
                     flag = False
         return project_requirements, project_code
             
-    def work(self):
+    def _stage_options(self, stage, temperature=0.2, top_p=0.5):
         """
-        Запуск работы агентов
+        Модель, модели для эскалации и проверка формата ответа для этапа.
 
-        return: сохраняет файл с кратким и полным отчетом
+        stage: ключ этапа из STAGE_TIERS.
+        temperature, top_p: параметры генерации.
+        return: словарь аргументов Agent.
         """
-        # Создаем общую память для агентов
-        shared_memory = Memory()
-        rag = Rag()
-        # Очистка общей памяти и загрузка исходных данных
-        shared_memory.clear()
-        results = {}
+        options = {
+            "format_check": STAGE_FORMAT_CHECKS.get(stage),
+            "stats": self.stats,
+            "recorder": self.recorder,
+            "retry_delay": self.retry_delay,
+        }
+        if self.router is None:
+            return dict(options, model=self.gigachat_model)
+        tier = self.stage_tiers[stage]
+        return dict(
+            options,
+            model=self.router.get(tier, temperature, top_p),
+            escalation=self.router.escalation(tier, temperature, top_p),
+        )
 
+    def _build_agents(self, shared_memory):
+        """
+        Создает агентов, работающих с общей памятью.
+
+        shared_memory: общая память агентов.
+        return: словарь агентов по их назначению.
+        """
         # 0. Считывание и проверка входных данных
         # Приветствует и спрашивает, откуда пользователь хочет загрузить данные
         boss_agent = Agent(
@@ -293,9 +739,9 @@ class Main_Workflow:
                 Поприветствуй пользователя, расскажи, что ты AI agent, который проверяет бизнес требование, код а также соответсвие кода бизнес требованию. Спроси у пользователя, хочет ли он вставить ссылку на confluence с кодом и бизнес требованием или же хочет загрузить файлы. В ответе укажи только вопрос про файл или ссылку.
                 """
             ),
-            model=self.gigachat_model,
             memory=shared_memory,
-            name="Босс требований"
+            name="Босс требований",
+            **self._stage_options("boss_agent")
         )
         
         # Выделяет сущность, откуда пользователь хочет загрузить данные
@@ -305,16 +751,9 @@ class Main_Workflow:
                 Задача: Если в ответе пользователя есть что-то похожее на ссылку, то верни в ответе только одно слово - 'ссылку'. Если есть что-то похожее на 'файл', то верни в ответе только одно слово - 'файл'. Если нет ни ссылки ни файла, верни в ответе - "ничего нет"
                 """
             ),
-            model=GigaChat(
-                credentials=credentials,
-                verify_ssl_certs=False,
-                timeout=360,
-                temperature=0.1,
-                top_p=0.1,
-                model="GigaChat-Max"
-            ),
             memory=shared_memory,
-            name="Проверка сообщения"
+            name="Проверка сообщения",
+            **self._stage_options("wish_checker", temperature=0.1, top_p=0.1)
         )
         
          # Выделяет сущность, хочет ли пользователь загрузить данные
@@ -324,16 +763,9 @@ class Main_Workflow:
                 Задача: Если в ответе пользователя есть что-то похожее на желание использовать готовый инструмен, то верни в ответе только одно слово - 'да'. Если желания использовать нет, то верни в ответе - "нет". 
                 """
             ),
-            model=GigaChat(
-                credentials=credentials,
-                verify_ssl_certs=False,
-                timeout=360,
-                temperature=0.1,
-                top_p=0.1,
-                model="GigaChat-Max"
-            ),
             memory=shared_memory,
-            name="Проверка желания"
+            name="Проверка желания",
+            **self._stage_options("anwer_tool_checker", temperature=0.1, top_p=0.1)
         )
 
         # Проверяет, что пользователь передал именно Бизнес требование
@@ -344,16 +776,9 @@ class Main_Workflow:
                 2. Проверь, является ли предоставленный текст бизнес требованием, а не кодом или просто случайным текстом. Бизнес требование имеет примерно такую структуру: формулирует, что должен делать разработчик, какие результаты ожидать и какие ограничения учитывать.
                 3. Если предоставленный текст является бизнес требованием, то в итоговом ответе напиши - 'корректный ввод требований', если нет, напиши - 'некорректный ввод требований'"""
             ),
-            model=GigaChat(
-                credentials=credentials,
-                verify_ssl_certs=False,
-                timeout=360,
-                temperature=0.1,
-                top_p=0.1,
-                model="GigaChat-Max"
-            ),
             memory=shared_memory,
-            name="Андерайтер требований"
+            name="Андерайтер требований",
+            **self._stage_options("req_checker", temperature=0.1, top_p=0.1)
         )
 
         # Проверяет, что пользователь передал именно код
@@ -364,16 +789,9 @@ class Main_Workflow:
                 2. Проверь, является ли предоставленный текст кодом на Python, Java, SQL, C++ или Go, а не бизнес требованием или просто случайным текстом.
                 3. Если предоставленный текст является кодом, то в итоговом ответе напиши - 'корректный ввод кода', если нет, напиши - 'некорректный ввод кода'"""
             ),
-            model=GigaChat(
-                credentials=credentials,
-                verify_ssl_certs=False,
-                timeout=360,
-                temperature=0.1,
-                top_p=0.1,
-                model="GigaChat-Max"
-            ),
             memory=shared_memory,
-            name="Андерайтер кода"
+            name="Андерайтер кода",
+            **self._stage_options("code_checker", temperature=0.1, top_p=0.1)
         )
 
         # 1. Анализатор требований
@@ -383,9 +801,9 @@ class Main_Workflow:
                 "Выяви нечеткие определения, неопределённые числовые диапазоны, противоречивые условия, а также предложи рекомендации по их исправлению. "
                 "Вывод должен содержать список обнаруженных проблем и рекомендации для корректировки требований."
             ),
-            model=gigachat_model,
             memory=shared_memory,
-            name="Анализатор требований"
+            name="Анализатор требований",
+            **self._stage_options("req_analyzer")
         )
 
         # 2. Анализатор соответствия (сопоставление требований и кода)
@@ -398,9 +816,9 @@ class Main_Workflow:
                 "Выведи отчет, в котором указаны: требования, которые не реализованы в коде;"
                 "а также даны рекомендации по исправлению обнаруженных несоответствий."
             ),
-            model=gigachat_model,
             memory=shared_memory,
-            name="Анализатор соответствия"
+            name="Анализатор соответствия",
+            **self._stage_options("alignment_checker")
         )
 
         # 3. Анализатор кодов TODO code filler
@@ -412,9 +830,9 @@ class Main_Workflow:
                 "3. Соответствие логике и ограничениям: Строго соблюдай бизнес-логику, математические формулы и все ограничения, указанные в требованиях. Решение должно точно соответствовать описанным правилам работы.\n",
                 "4. В ответе верни только код."
             ),
-            model=gigachat_model,
             memory=shared_memory,
-            name="Код реализации LLM"
+            name="Код реализации LLM",
+            **self._stage_options("coder")
         )
 
         two_code_analyzer = Agent(
@@ -425,9 +843,9 @@ class Main_Workflow:
                 "В итоговом ответе необходимо сформировать список расхождений, обнаруженных в коде пользователя по сравнению с кодом LLM. " 
                 "Код LLM предоставлен исключительно для справки – его комментировать не нужно. Если математическая логика в коде пользователя идентична, выведи сообщение об отсутствии расхождений."
             ),
-            model=gigachat_model,
             memory=shared_memory,
-            name="Анализатор математической логики"
+            name="Анализатор математической логики",
+            **self._stage_options("two_code_analyzer")
         )
 
         # 4. Генератор отчёта
@@ -438,9 +856,9 @@ class Main_Workflow:
                 "Включи дополнительную информацию и подробности для каждого найденного пункта. "
                 "Вывод должен быть структурированным и понятным для разработчиков и аналитиков."
             ),
-            model=self.gigachat_model,
             memory=shared_memory,
-            name="Генератор отчёта"
+            name="Генератор отчёта",
+            **self._stage_options("report_generator")
         )
 
         # 5. Оценщик качества требований и кода
@@ -471,9 +889,9 @@ class Main_Workflow:
                 "Код: \"def sum_numbers(lst): result = 1; for num in lst: result *= num; return result\"\n"
                 "Вывод: \"Оценка требований: 100% - Требования сформулированы корректно.\\nОценка кода: 0% - Код реализует умножение вместо сложения, что не соответствует требованию.\""
             ),
-            model=self.gigachat_model,
             memory=shared_memory,
-            name="Оценщик качества"
+            name="Оценщик качества",
+            **self._stage_options("quality_evaluator")
         )
 
         # 6. Суммаризатор
@@ -492,78 +910,78 @@ class Main_Workflow:
                 "в раздел \"Отчет по коду\" – наиболее существенные несоответствия между требованиями и кодом, "
                 "а в разделе \"Оценка\" приведи итоговые оценки качества."
             ),
-            model=self.gigachat_model,
             memory=shared_memory,
-            name="Суммаризатор"
+            name="Суммаризатор",
+            **self._stage_options("summarizer_agent")
         )
-         
-        # 7. Агент, который отправляет данные в Jira и Confluence
-        agent_jira_confluence = initialize_agent(
-            tools=[self.create_jira_task, self.create_confluence_comment],
-            llm=gigachat_model,
-            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-            verbose=False)
-        
-        # 8. Работа агентов
-        # Приветствует пользователя
-        answer_boss_agent = boss_agent.run(
-                input_text="",
-                memory_key_read=None,
-                memory_key_write="Приветсвие пользователя")
-            
-        print(answer_boss_agent)
-        results["Приветствие пользователя"] = answer_boss_agent
-        time.sleep(2)
 
-        # Проверяет, что пользователь ввел и сохраняет данные
-        answer_user = input()
-        answer_user_material = wish_checker.run(input_text=f"n\Ответ от пользователя {answer_user}")
-        flag = True
-        while flag:
-            if 'ничего' not in answer_user_material:
-                self.project_requirements, self.project_code = self.data_read(answer_user_material)
-                shared_memory.append("Требования пользователя", self.project_requirements)
-                shared_memory.append("Код пользователя", self.project_code)
-                flag = False
-            else:
-                answer_user = input('Вы ввели что-то не то, отправьте свой ответ еще раз:')
-                answer_user_material = wish_checker.run(input_text=f"n\Ответ от пользователя {answer_user}")
-                
-        # Проверка кода и ТБ
-        flag = True
-        while flag:
-            # 0. Проверка входных данных
-            req_checker_ = req_checker.run(
-                input_text="Проверь, является ли предоставленный текст бизнес требованием, а не кодом или просто случайным текстом.",
-                memory_key_read="Требования пользователя",
-                memory_key_write="Проверка введеных требований"
-            )
-            results["Проверка введеных требований"] = req_checker_
-            time.sleep(5)
-        
-            code_checker_ = code_checker.run(
-                input_text="Проверь, является ли предоставленный текст кодом на Python, Java, SQL, C++ и Go, а не бизнес требованием или просто случайным текстом",
-                memory_key_read="Код пользователя",
-                memory_key_write="Проверка введеного кода"
-            )
-            results["Проверка введеного кода"] = code_checker_
-            time.sleep(5)
-            print(req_checker_.lower())
-            print(code_checker_.lower())
-            if ('некорректный' in req_checker_.lower()) or ('некорректный' in code_checker_.lower()):
-                print('Предоставленные материалы некорректны. Укажите их еще раз.')
-                self.project_requirements, self.project_code = self.data_read(answer_user_material)
-                shared_memory.append("Требования пользователя", self.project_requirements)
-                shared_memory.append("Код пользователя", self.project_code)
-            else:
-                flag = False
-                
+        return {
+            "boss_agent": boss_agent,
+            "wish_checker": wish_checker,
+            "anwer_tool_checker": anwer_tool_checker,
+            "req_checker": req_checker,
+            "code_checker": code_checker,
+            "req_analyzer": req_analyzer,
+            "alignment_checker": alignment_checker,
+            "coder": coder,
+            "two_code_analyzer": two_code_analyzer,
+            "report_generator": report_generator,
+            "quality_evaluator": quality_evaluator,
+            "summarizer_agent": summarizer_agent,
+        }
+
+    def _prepare_review(self, rag, shared_memory, agents):
+        """
+        Подготавливает общую память, агентов и RAG для анализа.
+
+        Если память не передана, создает ее и загружает в нее требования и код из self.
+        return: кортеж (rag, shared_memory, agents).
+        """
+        if shared_memory is None:
+            shared_memory = Memory()
+            shared_memory.append("Требования пользователя", self.project_requirements)
+            shared_memory.append("Код пользователя", self.project_code)
+        agents = agents or self._build_agents(shared_memory)
+        rag = rag or Rag()
+        return rag, shared_memory, agents
+
+    def _speculative_stages(self):
+        return [stage for stage in SPECULATIVE_STAGES if self.stage_modes.get(stage) == "speculative"]
+
+    def _final_stage_call(self, stage, early):
+        """
+        Аргументы запуска этапа по подробному отчету.
+
+        stage: "quality_evaluator" или "summarizer_agent".
+        early: ранние результаты спекулятивных этапов.
+        return: аргументы Agent.run: обычный запуск, если ранний результат не получен, сверка раннего результата
+                с подробным отчетом при reconcile, None - ранний результат используется как есть.
+        """
+        if not early.get(stage):
+            return FINAL_STAGE_CALLS[stage]
+        if not self.reconcile:
+            return None
+        call = RECONCILE_STAGE_CALLS[stage]
+        return dict(call, input_text=call["input_text"].format(early=early[stage]))
+
+    def review(self, rag=None, shared_memory=None, agents=None):
+        """
+        Анализ требований и кода без диалога с пользователем.
+
+        rag: объект Rag, если не указан - создается новый.
+        shared_memory: общая память с загруженными требованиями и кодом, если не указана - создается по self.
+        agents: агенты из _build_agents, если не указаны - создаются новые.
+        return: словарь с результатами анализа, полным и кратким отчетом.
+        """
+        rag, shared_memory, agents = self._prepare_review(rag, shared_memory, agents)
+        results = {}
+
         # Запрос в RAG
-        data_rag = rag.get_data(self.project_requirements)
+        data_rag = self._call("RAG", rag.get_data, self.project_requirements)
         shared_memory.append("Требования пользователя RAG", f"{self.project_requirements}\n{data_rag}")
         
         # Анализ требований
-        req_analysis = req_analyzer.run(
+        req_analysis = agents["req_analyzer"].run(
             input_text="Проанализируй представленные требования на предмет логических ошибок, двусмысленностей и противоречий.",
             memory_key_read="Требования пользователя RAG",
             memory_key_write="Анализ требований"
@@ -575,7 +993,7 @@ class Main_Workflow:
         # Объединяем исходные требования и код для сравнения
         combined_input = f"Требования:\n{self.project_requirements}\n\nКод:\n{self.project_code}"
         shared_memory.append("Реализация проекта", combined_input)
-        alignment_analysis = alignment_checker.run(
+        alignment_analysis = agents["alignment_checker"].run(
             input_text="Сопоставь представленные требования и код, выяви несоответствия (отсутствующие функции, неверные диапазоны, архитектурные нарушения) и дай рекомендации.",
             memory_key_read="Реализация проекта",
             memory_key_write="Анализ соответствия"
@@ -584,7 +1002,7 @@ class Main_Workflow:
         time.sleep(5)
         
         # Анализатор кодов
-        llm_code = coder.run(
+        llm_code = agents["coder"].run(
             input_text="",
             memory_key_read="Требования пользователя",
             memory_key_write="Код LLM"
@@ -593,7 +1011,7 @@ class Main_Workflow:
 
         combined_code = f"Код пользователя:\n{self.project_code}\n\nКод LLM:\n{llm_code}"
         shared_memory.append("Коды", combined_code)
-        two_code_analysis = two_code_analyzer.run(
+        two_code_analysis = agents["two_code_analyzer"].run(
             input_text="Сравни код пользователя и LLM-код по математической корректности и выведи список расхождений или сообщение об их отсутствии, игнорируя стиль и архитектуру.",
             memory_key_read="Коды",
             memory_key_write="Анализ кодов"
@@ -608,43 +1026,386 @@ class Main_Workflow:
         shared_memory.append("Информация по проекту", combined_analysis)
         time.sleep(5)
         
-        # Генерация подробного отчёта
+        # Генерация подробного отчёта, спекулятивные этапы выполняются параллельно с ним
         detail_flag = "Режим: подробный отчет. Включи все подробности по каждому обнаруженному пункту."
-        final_report = report_generator.run(
-            input_text=detail_flag,
-            memory_key_read="Информация по проекту",
-            memory_key_write="Отчет"
-        )
+        speculative = self._speculative_stages()
+        with ThreadPoolExecutor(max_workers=len(speculative) + 1) as pool:
+            futures = {stage: pool.submit(agents[stage].run, **SPECULATIVE_STAGE_CALLS[stage]) for stage in speculative}
+            final_report = agents["report_generator"].run(
+                input_text=detail_flag,
+                memory_key_read="Информация по проекту",
+                memory_key_write="Отчет"
+            )
+            early = {stage: future.result() for stage, future in futures.items()}
         time.sleep(5)
         
         # Оценка качества требований и кода
-        shared_memory.append("Оценка данных", final_report)
-        quality_evaluation = quality_evaluator.run(
-            input_text="Оцени соответствие требований и кода, выстави оценку по указанной шкале и дай короткий комментарий.",
-            memory_key_read="Оценка данных",
-            memory_key_write="Оценка качества"
-        )
-        
+        call = self._final_stage_call("quality_evaluator", early)
+        if call is not None:
+            shared_memory.append("Оценка данных", final_report)
+            quality_evaluation = agents["quality_evaluator"].run(**call)
+            time.sleep(5)
+        else:
+            quality_evaluation = early["quality_evaluator"]
         results["Оценка качества"] = quality_evaluation
-        time.sleep(5)
         
         # Добавление оценки качества в конец финального отчёта
         final_report += f"\n\nОценка качества требований и кода:\n{quality_evaluation}"
         results["Итоговый отчет"] = final_report
-        time.sleep(5)
         
-        # 6. Суммаризация – выделение самых серьезных недочетов и ошибок
-        shared_memory.append("Полный отчет", final_report)
-        summarized_report = summarizer_agent.run(
-            input_text="Сформируй суммаризованный отчет по заданной структуре.",
-            memory_key_read="Полный отчет",
-            memory_key_write="Суммаризованный отчет"
+        # Суммаризация – выделение самых серьезных недочетов и ошибок
+        if early.get("summarizer_agent"):
+            early["summarizer_agent"] = merge_evaluation(early["summarizer_agent"], quality_evaluation)
+        call = self._final_stage_call("summarizer_agent", early)
+        if call is not None:
+            time.sleep(5)
+            shared_memory.append("Полный отчет", final_report)
+            summarized_report = agents["summarizer_agent"].run(**call)
+        else:
+            summarized_report = early["summarizer_agent"]
+        results["Суммаризованный отчет"] = summarized_report
+        if self.recorder is not None:
+            self.recorder.finish(self, results)
+        return results
+
+    async def areview(self, rag=None, shared_memory=None, agents=None):
+        """
+        Асинхронный анализ требований и кода без диалога с пользователем.
+
+        Независимые шаги (анализ требований, сопоставление, генерация кода LLM) выполняются параллельно,
+        число одновременных запросов к модели ограничено общим семафором (LLM_CONCURRENCY).
+        Параметры и результат такие же, как у review.
+        """
+        rag, shared_memory, agents = self._prepare_review(rag, shared_memory, agents)
+        results = {}
+
+        # Запрос в RAG выполняется в отдельном потоке, чтобы не блокировать event loop
+        data_rag = await asyncio.to_thread(self._call, "RAG", rag.get_data, self.project_requirements)
+        shared_memory.append("Требования пользователя RAG", f"{self.project_requirements}\n{data_rag}")
+
+        combined_input = f"Требования:\n{self.project_requirements}\n\nКод:\n{self.project_code}"
+        shared_memory.append("Реализация проекта", combined_input)
+
+        req_analysis, alignment_analysis, llm_code = await asyncio.gather(
+            agents["req_analyzer"].arun(
+                input_text="Проанализируй представленные требования на предмет логических ошибок, двусмысленностей и противоречий.",
+                memory_key_read="Требования пользователя RAG",
+                memory_key_write="Анализ требований"
+            ),
+            agents["alignment_checker"].arun(
+                input_text="Сопоставь представленные требования и код, выяви несоответствия (отсутствующие функции, неверные диапазоны, архитектурные нарушения) и дай рекомендации.",
+                memory_key_read="Реализация проекта",
+                memory_key_write="Анализ соответствия"
+            ),
+            agents["coder"].arun(
+                input_text="",
+                memory_key_read="Требования пользователя",
+                memory_key_write="Код LLM"
+            ),
+        )
+        results["Анализ требований"] = req_analysis
+        results["Анализ соответствия"] = alignment_analysis
+        results["Код LLM"] = llm_code
+
+        combined_code = f"Код пользователя:\n{self.project_code}\n\nКод LLM:\n{llm_code}"
+        shared_memory.append("Коды", combined_code)
+        two_code_analysis = await agents["two_code_analyzer"].arun(
+            input_text="Сравни код пользователя и LLM-код по математической корректности и выведи список расхождений или сообщение об их отсутствии, игнорируя стиль и архитектуру.",
+            memory_key_read="Коды",
+            memory_key_write="Анализ кодов"
+        )
+        results["Анализ кодов"] = two_code_analysis
+
+        combined_analysis = f"""Результаты анализа требований:\n{req_analysis}\n
+        Результаты сопоставления:\n{alignment_analysis}\n
+        Результаты математической корректности:\n{two_code_analysis}\n"""
+        shared_memory.append("Информация по проекту", combined_analysis)
+
+        # Спекулятивные этапы выполняются параллельно с подробным отчетом
+        detail_flag = "Режим: подробный отчет. Включи все подробности по каждому обнаруженному пункту."
+        speculative = self._speculative_stages()
+        final_report, *early_results = await asyncio.gather(
+            agents["report_generator"].arun(
+                input_text=detail_flag,
+                memory_key_read="Информация по проекту",
+                memory_key_write="Отчет"
+            ),
+            *[agents[stage].arun(**SPECULATIVE_STAGE_CALLS[stage]) for stage in speculative],
         )
+        early = dict(zip(speculative, early_results))
+
+        call = self._final_stage_call("quality_evaluator", early)
+        if call is not None:
+            shared_memory.append("Оценка данных", final_report)
+            quality_evaluation = await agents["quality_evaluator"].arun(**call)
+        else:
+            quality_evaluation = early["quality_evaluator"]
+        results["Оценка качества"] = quality_evaluation
+
+        final_report += f"\n\nОценка качества требований и кода:\n{quality_evaluation}"
+        results["Итоговый отчет"] = final_report
+
+        if early.get("summarizer_agent"):
+            early["summarizer_agent"] = merge_evaluation(early["summarizer_agent"], quality_evaluation)
+        call = self._final_stage_call("summarizer_agent", early)
+        if call is not None:
+            shared_memory.append("Полный отчет", final_report)
+            summarized_report = await agents["summarizer_agent"].arun(**call)
+        else:
+            summarized_report = early["summarizer_agent"]
         results["Суммаризованный отчет"] = summarized_report
+        if self.recorder is not None:
+            await asyncio.to_thread(self.recorder.finish, self, results)
+        return results
+
+    async def areview_project(self, code_path, requirements_page_id=None, rag=None, chunk_size=4000,
+                              chunk_overlap=200, top_k=5, max_workers=8, module_depth=1, reduce_chars=16000):
+        """
+        Асинхронный анализ проекта: дерево страниц требований и директория или zip-архив с кодом.
+
+        Страницы и файлы читаются параллельно и обрабатываются потоком: требования разбиваются на фрагменты
+        и индексируются BM25, каждый фрагмент кода сопоставляется с top_k наиболее близкими фрагментами требований.
+        Ответы по фрагментам сводятся иерархически: пачками не больше reduce_chars символов, затем сводятся
+        результаты пачек, пока не останется один отчет - по каждому модулю, по требованиям и по проекту.
+        Поэтому размер каждого запроса к модели не зависит от размера проекта, а число одновременно
+        обрабатываемых фрагментов ограничено max_workers.
+
+        code_path: директория или zip-архив с исходным кодом.
+        requirements_page_id: идентификатор корневой страницы требований, если не указан - используются self.project_requirements.
+        rag: объект Rag, если не указан - создается новый.
+        chunk_size: размер фрагмента требований и кода.
+        chunk_overlap: перекрытие фрагментов.
+        top_k: количество фрагментов требований для каждого фрагмента кода.
+        max_workers: количество потоков чтения и одновременно обрабатываемых фрагментов.
+        module_depth: количество уровней директорий, определяющих модуль.
+        reduce_chars: максимальный размер контекста одного запроса при свертке отчетов.
+        return: словарь с анализом требований, отчетами по модулям, итоговым и кратким отчетом.
+        """
+        rag = rag or Rag()
+        base_agents = self._build_agents(Memory())
+        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        index = BM25Index()
+        slots = asyncio.Semaphore(max_workers)
+        done = object()
+        spawned = []
+
+        async def run_agent(name, memory_key, context, input_text):
+            # У каждого вызова своя память: контекст не накапливается между фрагментами
+            memory = Memory()
+            memory.append(memory_key, context)
+            agent = copy.copy(base_agents[name])
+            agent.memory = memory
+            try:
+                return await agent.arun(input_text=input_text, memory_key_read=memory_key)
+            finally:
+                slots.release()
+
+        async def spawn(name, memory_key, context, input_text):
+            # Не читаем следующий фрагмент, пока не освободится место: память ограничена max_workers фрагментами
+            await slots.acquire()
+            task = asyncio.create_task(run_agent(name, memory_key, context, input_text))
+            spawned.append(task)
+            return task
+
+        async def iterate(items):
+            iterator = iter(items)
+            while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+                yield item
+
+        async def reduce(items, input_text):
+            # Иерархическая свертка: каждый запрос получает не больше reduce_chars символов
+            if not items:
+                return ""
+            while True:
+                tasks = [
+                    await spawn("report_generator", "Информация по проекту", "\n\n".join(batch), input_text)
+                    for batch in batch_texts(items, reduce_chars)
+                ]
+                items = [str(result) for result in await asyncio.gather(*tasks)]
+                if len(items) == 1:
+                    return items[0]
+
+        # Если чтение страниц или файлов завершилось ошибкой, запущенные запросы отменяются
+        try:
+            # 1. Требования: индексация и анализ по фрагментам
+            if requirements_page_id is not None:
+                def list_children(page_id):
+                    return self._call("Confluence children", list_confluence_children, page_id)
+                pages = iter_confluence_tree(requirements_page_id, self.load_page, list_children, max_workers)
+            else:
+                pages = [("Требования", self.project_requirements)]
+            req_tasks = []
+            async for title, text in iterate(pages):
+                for chunk in splitter.split_text(text):
+                    index.add(Document(page_content=chunk, metadata={"page": title}))
+                    data_rag = await asyncio.to_thread(self._call, "RAG", rag.get_data, chunk)
+                    task = await spawn(
+                        "req_analyzer", "Требования пользователя RAG", f"{chunk}\n{data_rag}",
+                        f"Проанализируй фрагмент требований со страницы \"{title}\" на предмет логических ошибок, двусмысленностей и противоречий.",
+                    )
+                    req_tasks.append((title, task))
+
+            # 2. Код: сопоставление фрагментов каждого модуля с релевантными требованиями
+            # Фрагменты собираются по модулю, даже если его файлы пришли несколькими группами
+            module_chunks = defaultdict(list)
+            async for module, files in iterate(iter_modules(iter_source_files(code_path, max_workers), module_depth)):
+                chunk_tasks = module_chunks[module]
+                async for path, text in iterate(files):
+                    for chunk in splitter.split_text(text):
+                        fragments = [doc.page_content for doc, _ in index.search(chunk, top_k)]
+                        context = "Требования:\n" + "\n\n".join(fragments) + f"\n\nКод ({path}):\n{chunk}"
+                        task = await spawn(
+                            "alignment_checker", "Реализация проекта", context,
+                            "Сопоставь фрагменты требований и фрагмент кода, выяви несоответствия (отсутствующие функции, неверные диапазоны, архитектурные нарушения) и дай рекомендации.",
+                        )
+                        chunk_tasks.append((path, task))
+
+            # 3. Свертка: отчет по требованиям и отчеты по модулям
+            async def requirements_report():
+                analyses = [f"Страница {title}:\n{await task}" for title, task in req_tasks]
+                summary = await reduce(
+                    analyses,
+                    "Сведи анализ фрагментов требований: перечисли логические ошибки, двусмысленности, противоречия и рекомендации по их исправлению.",
+                )
+                return "\n\n".join(analyses), summary
+
+            async def module_report(module, chunk_tasks):
+                findings = [f"Файл {path}:\n{await task}" for path, task in chunk_tasks]
+                return await reduce(
+                    findings,
+                    f"Сформируй отчет по модулю {module}: перечисли требования, которые не реализованы или реализованы неверно, и рекомендации.",
+                )
+
+            (req_analysis, req_summary), *module_reports = await asyncio.gather(
+                requirements_report(),
+                *[module_report(module, chunk_tasks) for module, chunk_tasks in module_chunks.items()],
+            )
+            results = {
+                "Анализ требований": req_analysis,
+                "Анализ модулей": dict(zip(module_chunks, module_reports)),
+            }
+
+            # 4. Итоговый отчет по проекту из отчета по требованиям и отчетов по модулям
+            final_report = await reduce(
+                [f"Анализ требований:\n{req_summary}"]
+                + [f"Модуль {module}:\n{report}" for module, report in results["Анализ модулей"].items()],
+                "Сформируй итоговый отчет по проекту: самые важные проблемы требований, несоответствия кода требованиям по модулям и рекомендации.",
+            )
+            await slots.acquire()
+            quality_evaluation = await run_agent("quality_evaluator", "Оценка данных", final_report, FINAL_STAGE_CALLS["quality_evaluator"]["input_text"])
+            results["Оценка качества"] = quality_evaluation
+            final_report += f"\n\nОценка качества требований и кода:\n{quality_evaluation}"
+            results["Итоговый отчет"] = final_report
+
+            await slots.acquire()
+            results["Суммаризованный отчет"] = await run_agent(
+                "summarizer_agent", "Полный отчет", final_report, FINAL_STAGE_CALLS["summarizer_agent"]["input_text"]
+            )
+        finally:
+            pending = [task for task in spawned if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if self.recorder is not None:
+            project = dict(
+                code_path=os.path.abspath(code_path), requirements_page_id=requirements_page_id, chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap, top_k=top_k, max_workers=max_workers, module_depth=module_depth,
+                reduce_chars=reduce_chars,
+            )
+            await asyncio.to_thread(self.recorder.finish, self, results, project)
+        return results
+
+    def review_project(self, code_path, requirements_page_id=None, **kwargs):
+        """
+        Синхронный вариант areview_project, параметры и результат те же.
+        """
+        return asyncio.run(self.areview_project(code_path, requirements_page_id, **kwargs))
+
+    def work(self):
+        """
+        Запуск работы агентов
+
+        return: сохраняет файл с кратким и полным отчетом
+        """
+        # Создаем общую память для агентов
+        shared_memory = Memory()
+        rag = Rag()
+        # Очистка общей памяти и загрузка исходных данных
+        shared_memory.clear()
+        results = {}
+
+        # 0-6. Агенты проверки входных данных и анализа
+        agents = self._build_agents(shared_memory)
+
+        # 7. Агент, который отправляет данные в Jira и Confluence
+        agent_jira_confluence = initialize_agent(
+            tools=[self.create_jira_task, self.create_confluence_comment],
+            llm=gigachat_model,
+            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+            verbose=False)
+        
+        # 8. Работа агентов
+        # Приветствует пользователя
+        answer_boss_agent = agents["boss_agent"].run(
+                input_text="",
+                memory_key_read=None,
+                memory_key_write="Приветсвие пользователя")
+            
+        print(answer_boss_agent)
+        results["Приветствие пользователя"] = answer_boss_agent
+        time.sleep(2)
+
+        # Проверяет, что пользователь ввел и сохраняет данные
+        answer_user = input()
+        answer_user_material = agents["wish_checker"].run(input_text=f"n\Ответ от пользователя {answer_user}")
+        flag = True
+        while flag:
+            if 'ничего' not in answer_user_material:
+                self.project_requirements, self.project_code = self.data_read(answer_user_material)
+                shared_memory.append("Требования пользователя", self.project_requirements)
+                shared_memory.append("Код пользователя", self.project_code)
+                flag = False
+            else:
+                answer_user = input('Вы ввели что-то не то, отправьте свой ответ еще раз:')
+                answer_user_material = agents["wish_checker"].run(input_text=f"n\Ответ от пользователя {answer_user}")
+                
+        # Проверка кода и ТБ
+        flag = True
+        while flag:
+            # 0. Проверка входных данных
+            req_checker_ = agents["req_checker"].run(
+                input_text="Проверь, является ли предоставленный текст бизнес требованием, а не кодом или просто случайным текстом.",
+                memory_key_read="Требования пользователя",
+                memory_key_write="Проверка введеных требований"
+            )
+            results["Проверка введеных требований"] = req_checker_
+            time.sleep(5)
+        
+            code_checker_ = agents["code_checker"].run(
+                input_text="Проверь, является ли предоставленный текст кодом на Python, Java, SQL, C++ и Go, а не бизнес требованием или просто случайным текстом",
+                memory_key_read="Код пользователя",
+                memory_key_write="Проверка введеного кода"
+            )
+            results["Проверка введеного кода"] = code_checker_
+            time.sleep(5)
+            print(req_checker_.lower())
+            print(code_checker_.lower())
+            if ('некорректный' in req_checker_.lower()) or ('некорректный' in code_checker_.lower()):
+                print('Предоставленные материалы некорректны. Укажите их еще раз.')
+                self.project_requirements, self.project_code = self.data_read(answer_user_material)
+                shared_memory.append("Требования пользователя", self.project_requirements)
+                shared_memory.append("Код пользователя", self.project_code)
+            else:
+                flag = False
+                
+        # Анализ требований и кода, формирование полного и краткого отчета
+        results.update(self.review(rag=rag, shared_memory=shared_memory, agents=agents))
+
         # Спрашиваем пользователя, что он хочет сделать
         answer_conf = input('Хотите ли Вы загрузить данные на конфлюенс?')
-        answer_agent = anwer_tool_checker.run(input_text=f"n\Ответ от пользователя {answer_conf}")
-        if answer_agent.lower() == 'да':
+        answer_agent = agents["anwer_tool_checker"].run(input_text=f"n\Ответ от пользователя {answer_conf}")
+        if parse_yes_no(answer_agent) == 'да':
             while True:
                 try:
                     promt = input("Напишите свой запрос агенту. Не забудьте указать ссылку на Confluence:")
@@ -664,8 +1425,8 @@ class Main_Workflow:
 
         # Спрашиваем пользователя,что он хочет сделать
         answer_jira = input('Хотите ли Вы создать задачу в Jira на доработку?')
-        answer_agent = anwer_tool_checker.run(input_text=f"n\Ответ от пользователя {answer_jira}")
-        if answer_agent.lower() == 'да':
+        answer_agent = agents["anwer_tool_checker"].run(input_text=f"n\Ответ от пользователя {answer_jira}")
+        if parse_yes_no(answer_agent) == 'да':
             while True:
                 try:
                     promt = input("Напишите свой запрос агенту. Не забудьте указать ссылку на Jira, заголовок и описание задачи:")
@@ -691,4 +1452,8 @@ class Main_Workflow:
             output.write(results["Итоговый отчет"])
                 
         print('Краткий и полный отчет сохранены в файл!')
+
+        # Задержка и стоимость по этапам
+        logging.info(f"Статистика по этапам:\n{self.stats.report()}")
+        print(self.stats.report())
         return
\ No newline at end of file
@@ -0,0 +1,163 @@
+import os
+import zipfile
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Расширения файлов, которые считаются исходным кодом
+SOURCE_EXTENSIONS = {
+    ".py", ".java", ".kt", ".scala", ".sql", ".go", ".c", ".h", ".cpp", ".hpp", ".cc", ".cs",
+    ".js", ".jsx", ".ts", ".tsx", ".rb", ".php", ".rs", ".swift", ".sh", ".yaml", ".yml",
+}
+# Служебные директории, которые не анализируются
+SKIP_DIRS = {".git", ".hg", ".svn", "__pycache__", "node_modules", ".venv", "venv", "build", "dist", ".idea"}
+
+
+def bounded_map(func, items, max_workers=8):
+    """
+    Параллельный map с ограниченным упреждением: одновременно выполняется и хранится
+    не больше max_workers результатов, порядок результатов сохраняется.
+
+    func: функция одного аргумента.
+    items: итерируемый объект.
+    return: генератор результатов.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def batch_texts(texts, max_chars):
+    """
+    Разбивает тексты на пачки для иерархической свертки: в пачке не больше max_chars символов.
+
+    Тексты длиннее max_chars // 2 обрезаются, а в каждой пачке, кроме последней, не меньше двух текстов,
+    поэтому каждый уровень свертки уменьшает количество текстов хотя бы вдвое.
+
+    texts: список текстов.
+    max_chars: максимальный размер пачки.
+    return: список пачек (списков текстов).
+    """
+    limit = max_chars // 2
+    batches, batch, size = [], [], 0
+    for text in texts:
+        if len(text) > limit:
+            text = text[:limit] + "\n[...]"
+        if len(batch) >= 2 and size + len(text) > max_chars:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(text)
+        size += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _is_source(path):
+    return os.path.splitext(path)[1].lower() in SOURCE_EXTENSIONS
+
+
+def _decode(data):
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+def _walk_order(path):
+    """Ключ сортировки путей в порядке обхода директорий: сначала файлы директории, затем ее поддиректории."""
+    parts = path.split("/")
+    return parts[:-1], parts[-1]
+
+
+def iter_source_files(path, max_workers=8):
+    """
+    Читает исходный код из директории или zip-архива.
+
+    Файлы читаются параллельно и выдаются по одному в порядке обхода директорий (как os.walk с сортировкой),
+    поэтому файлы одного модуля идут подряд при любой глубине модуля.
+    Файлы не в UTF-8 пропускаются.
+
+    path: путь к директории или zip-архиву.
+    max_workers: количество потоков чтения.
+    return: генератор пар (относительный путь, текст).
+    """
+    if zipfile.is_zipfile(path):
+        # Один zip-файл не читается из нескольких потоков, поэтому архив читается последовательно
+        with zipfile.ZipFile(path) as archive:
+            names = sorted((
+                info.filename for info in archive.infolist()
+                if not info.is_dir() and _is_source(info.filename)
+                and not SKIP_DIRS.intersection(info.filename.split("/"))
+            ), key=_walk_order)
+            for name in names:
+                text = _decode(archive.read(name))
+                if text is not None:
+                    yield name, text
+        return
+
+    if not os.path.isdir(path):
+        raise ValueError(f"Ожидается директория или zip-архив с кодом: {path}")
+
+    def relative_paths():
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+            for name in sorted(files):
+                if _is_source(name):
+                    yield os.path.relpath(os.path.join(root, name), path).replace(os.sep, "/")
+
+    def read(relative_path):
+        with open(os.path.join(path, relative_path), "rb") as file:
+            return relative_path, _decode(file.read())
+
+    for relative_path, text in bounded_map(read, relative_paths(), max_workers):
+        if text is not None:
+            yield relative_path, text
+
+
+def iter_modules(files, depth=1):
+    """
+    Группирует поток файлов по модулям: модуль - первые depth директорий пути, файлы в корне - отдельные модули.
+
+    files: генератор пар (путь, текст) в порядке iter_source_files.
+           Если файлы модуля идут не подряд, модуль выдается несколько раз.
+    return: генератор пар (модуль, генератор файлов модуля).
+    """
+    def module_of(item):
+        parts = item[0].split("/")
+        return "/".join(parts[:min(depth, len(parts) - 1)]) or parts[-1]
+
+    return itertools.groupby(files, key=module_of)
+
+
+def iter_confluence_tree(root_page_id, load_page, list_children, max_workers=8):
+    """
+    Обходит дерево страниц Confluence в ширину и загружает их параллельно.
+
+    root_page_id: идентификатор корневой страницы.
+    load_page: функция загрузки текста страницы по идентификатору.
+    list_children: функция, возвращающая список пар (идентификатор, заголовок) дочерних страниц.
+    max_workers: количество потоков загрузки.
+    return: генератор пар (заголовок или идентификатор страницы, текст).
+    """
+    def pages():
+        queue = deque([(root_page_id, root_page_id)])
+        seen = {root_page_id}
+        while queue:
+            page_id, title = queue.popleft()
+            yield page_id, title
+            for child_id, child_title in list_children(page_id):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    queue.append((child_id, child_title))
+
+    def read(page):
+        page_id, title = page
+        return title, load_page(page_id)
+
+    yield from bounded_map(read, pages(), max_workers)
@@ -0,0 +1,109 @@
+import re
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+try:
+    # Заголовок X-Session-ID включает кэширование контекста на стороне GigaChat
+    from gigachat.context import session_id_cvar
+except ImportError:
+    session_id_cvar = None
+
+
+def compact(text):
+    """
+    Приводит описание роли к компактному виду: убирает отступы строк и лишние пустые строки.
+
+    text: строка или последовательность строк, которые склеиваются без разделителя.
+    return: строка.
+    """
+    if isinstance(text, (list, tuple)):
+        text = "".join(text)
+    lines = [line.strip() for line in text.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+
+class PromptStats:
+    def __init__(self):
+        """Статистика отправленных промптов: переиспользование стабильного префикса."""
+        self._lock = threading.Lock()
+        self._prefixes = set()
+        self.calls = 0
+        self.prefix_chars = 0
+        self.reused_prefix_chars = 0
+        self.suffix_chars = 0
+
+    def record(self, prefix, suffix):
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        with self._lock:
+            self.calls += 1
+            self.prefix_chars += len(prefix)
+            self.suffix_chars += len(suffix)
+            if key in self._prefixes:
+                self.reused_prefix_chars += len(prefix)
+            else:
+                self._prefixes.add(key)
+
+    def summary(self):
+        """
+        return: словарь со счетчиками и долей символов, отправленных в уже встречавшемся префиксе.
+        """
+        with self._lock:
+            total = self.prefix_chars + self.suffix_chars
+            return {
+                "calls": self.calls,
+                "unique_prefixes": len(self._prefixes),
+                "prefix_chars": self.prefix_chars,
+                "reused_prefix_chars": self.reused_prefix_chars,
+                "suffix_chars": self.suffix_chars,
+                "prefix_reuse_ratio": self.reused_prefix_chars / total if total else 0.0,
+            }
+
+
+# Общая статистика процесса
+prompt_stats = PromptStats()
+
+
+def build_messages(system_prompt, input_text, context=None, context_key=None, stats=prompt_stats):
+    """
+    Собирает запрос из стабильного префикса (описание роли) и переменной части (контекст и задание).
+    Контекст передается без изменений: повторные записи отсекает Memory, код в контексте не переписывается.
+
+    system_prompt: компактное описание роли, одинаковое для всех вызовов агента.
+    input_text: задание для модели.
+    context: контекст из памяти.
+    context_key: ключ памяти, из которого взят контекст.
+    stats: объект PromptStats для учета.
+    return: список сообщений [SystemMessage, HumanMessage].
+    """
+    parts = []
+    if context:
+        parts.append(f"Контекст из памяти [{context_key}]:\n{context}")
+    if input_text:
+        parts.append(input_text)
+    suffix = "\n\n".join(parts)
+
+    if stats is not None:
+        stats.record(system_prompt, suffix)
+    if not suffix:
+        # Модели нужно сообщение пользователя, поэтому роль без задания отправляется как обычный запрос
+        return [HumanMessage(content=system_prompt)]
+    return [SystemMessage(content=system_prompt), HumanMessage(content=suffix)]
+
+
+@contextmanager
+def prefix_session(system_prompt):
+    """
+    Передает в GigaChat идентификатор сессии, общий для всех запросов с одинаковым префиксом,
+    чтобы модель могла переиспользовать закэшированный контекст.
+    """
+    if session_id_cvar is None:
+        yield
+        return
+    token = session_id_cvar.set(hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:32])
+    try:
+        yield
+    finally:
+        session_id_cvar.reset(token)
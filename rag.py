@@ -1,5 +1,14 @@
 import os
+import re
+import math
+import array
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from collections import Counter, defaultdict
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain.vectorstores import Qdrant
 from langchain_gigachat.embeddings import GigaChatEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -123,34 +132,416 @@ big_texts = [
 docs = [Document(page_content=text) for text in texts]
 
 
-class Rag:
-    def __init__(self, top_k=3, chunk_size=512, chunk_overlap=50):
-        self.embeddings = GigaChatEmbeddings(
+# === Лексический поиск: стемминг и BM25 ===
+# Окончания стеммера Портера (Snowball) для русского языка
+_VOWELS = "аеиоуыэюя"
+_PERFECTIVE_GERUND_1 = ("вшись", "вши", "в")
+_PERFECTIVE_GERUND_2 = ("ившись", "ывшись", "ивши", "ывши", "ив", "ыв")
+_ADJECTIVE = ("ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой",
+              "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею")
+_PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")
+_PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+_REFLEXIVE = ("ся", "сь")
+_VERB_1 = ("ете", "йте", "ешь", "нно", "ла", "на", "ли", "ем", "ло", "но", "ет", "ют", "ны", "ть", "й", "л", "н")
+_VERB_2 = ("ейте", "уйте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено", "ует", "уют", "ены",
+           "ить", "ыть", "ишь", "ей", "уй", "ил", "ыл", "им", "ым", "ен", "ят", "ит", "ыт", "ую", "ю")
+_NOUN = ("иями", "ями", "ами", "ией", "иям", "ием", "иях", "ев", "ов", "ие", "ье", "еи", "ии", "ей", "ой", "ий",
+         "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия", "ья", "а", "е", "и", "й", "о", "у", "ы", "ь", "ю", "я")
+_SUPERLATIVE = ("ейше", "ейш")
+_DERIVATIONAL = ("ость", "ост")
+
+# Слова разделяются пробелами и пунктуацией, но "и/или", "т.д" и т.п. остаются одним токеном
+_TOKEN_RE = re.compile(r"\w+(?:[/.]\w+)*")
+_CYRILLIC_RE = re.compile(r"[а-я]+")
+
+
+def _strip_ending(word, endings, after_a=False):
+    """
+    Отрезает первое подходящее окончание.
+
+    after_a: окончание допустимо только после "а" или "я".
+    return: слово без окончания или None, если окончание не найдено.
+    """
+    for ending in endings:
+        if word.endswith(ending):
+            stem = word[:-len(ending)]
+            if not after_a or stem.endswith(("а", "я")):
+                return stem
+    return None
+
+
+def _region_start(word, start=0):
+    """Начало области после первой пары "гласная-согласная" (R1/R2 в терминах Snowball)."""
+    for i in range(start + 1, len(word)):
+        if word[i] not in _VOWELS and word[i - 1] in _VOWELS:
+            return i + 1
+    return len(word)
+
+
+def stem_ru(word):
+    """
+    Стемминг русского слова по алгоритму Snowball.
+
+    word: слово в любом регистре.
+    return: основа слова; слова не на кириллице возвращаются в нижнем регистре без изменений.
+    """
+    word = word.lower().replace("ё", "е")
+    if not _CYRILLIC_RE.fullmatch(word):
+        return word
+
+    # RV - часть слова после первой гласной
+    rv_start = next((i + 1 for i, ch in enumerate(word) if ch in _VOWELS), len(word))
+    head, rv = word[:rv_start], word[rv_start:]
+    r2 = max(_region_start(word, _region_start(word)) - rv_start, 0)
+
+    # Шаг 1: деепричастия, иначе возвратные частицы и прилагательные/глаголы/существительные
+    stem = _strip_ending(rv, _PERFECTIVE_GERUND_1, after_a=True)
+    if stem is None:
+        stem = _strip_ending(rv, _PERFECTIVE_GERUND_2)
+    if stem is None:
+        rv = _strip_ending(rv, _REFLEXIVE) or rv
+        stem = _strip_ending(rv, _ADJECTIVE)
+        if stem is not None:
+            participle = _strip_ending(stem, _PARTICIPLE_1, after_a=True)
+            if participle is None:
+                participle = _strip_ending(stem, _PARTICIPLE_2)
+            if participle is not None:
+                stem = participle
+        if stem is None:
+            stem = _strip_ending(rv, _VERB_1, after_a=True)
+        if stem is None:
+            stem = _strip_ending(rv, _VERB_2)
+        if stem is None:
+            stem = _strip_ending(rv, _NOUN)
+    rv = rv if stem is None else stem
+
+    # Шаг 2: "и" на конце
+    if rv.endswith("и"):
+        rv = rv[:-1]
+
+    # Шаг 3: словообразовательные суффиксы в R2
+    for ending in _DERIVATIONAL:
+        if rv.endswith(ending) and len(rv) - len(ending) >= r2:
+            rv = rv[:-len(ending)]
+            break
+
+    # Шаг 4: "нн", превосходная степень и мягкий знак
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    else:
+        stem = _strip_ending(rv, _SUPERLATIVE)
+        if stem is not None:
+            rv = stem[:-1] if stem.endswith("нн") else stem
+        elif rv.endswith("ь"):
+            rv = rv[:-1]
+    return head + rv
+
+
+def tokenize(text):
+    """Разбивает текст на токены и приводит их к основам."""
+    return [stem_ru(token) for token in _TOKEN_RE.findall(text.lower())]
+
+
+class BM25Index:
+    def __init__(self, documents=(), k1=1.5, b=0.75):
+        """
+        Инвертированный индекс BM25 (Okapi) по корпусу документов, работает локально без эмбеддингов.
+
+        documents: список Document, документы также можно добавлять по одному через add.
+        k1: насыщение частоты термина.
+        b: нормализация по длине документа.
+        """
+        self.documents = []
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)
+        self.doc_lens = []
+        self._stale = True
+        for doc in documents:
+            self.add(doc)
+
+    def add(self, document):
+        """Добавляет документ в индекс."""
+        doc_id = len(self.documents)
+        self.documents.append(document)
+        terms = Counter(tokenize(document.page_content))
+        self.doc_lens.append(sum(terms.values()))
+        for term, tf in terms.items():
+            self.postings[term][doc_id] = tf
+        self._stale = True
+
+    def _refresh(self):
+        # Нормировка по длине документа и idf не зависят от запроса, поэтому пересчитываются только после добавления документов
+        n_docs = len(self.documents)
+        avgdl = (sum(self.doc_lens) / n_docs) if n_docs else 0.0
+        self.doc_norm = [
+            self.k1 * (1 - self.b + self.b * length / avgdl) if avgdl else self.k1 for length in self.doc_lens
+        ]
+        self.idf = {
+            term: math.log(1 + (n_docs - len(docs_tf) + 0.5) / (len(docs_tf) + 0.5))
+            for term, docs_tf in self.postings.items()
+        }
+        self._stale = False
+
+    def scores(self, text):
+        """
+        Считает BM25 для всех документов, содержащих термины запроса.
+
+        text: текст запроса.
+        return: словарь {номер документа: оценка}.
+        """
+        if self._stale:
+            self._refresh()
+        scores = defaultdict(float)
+        for term in set(tokenize(text)):
+            docs_tf = self.postings.get(term)
+            if not docs_tf:
+                continue
+            idf = self.idf[term]
+            for doc_id, tf in docs_tf.items():
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.doc_norm[doc_id])
+        return scores
+
+    def search(self, text, k):
+        """
+        Возвращает k лучших документов по BM25.
+
+        return: список пар (Document, оценка).
+        """
+        scores = self.scores(text)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.documents[doc_id], score) for doc_id, score in best]
+
+
+def _normalize_scores(scores):
+    """Min-max нормализация оценок в диапазон [0, 1]."""
+    if not scores:
+        return {}
+    low, high = min(scores.values()), max(scores.values())
+    if high == low:
+        return {key: 1.0 for key in scores}
+    return {key: (value - low) / (high - low) for key, value in scores.items()}
+
+
+# === Эмбеддинги: локальный бэкенд и общий кэш на диске ===
+class HashingEmbeddings(Embeddings):
+    def __init__(self, dim=512, ngram=3):
+        """
+        Локальные эмбеддинги на CPU без обращений к API (feature hashing).
+
+        Вектор строится по основам слов и символьным n-граммам основ, поэтому
+        близкие словоформы и опечатки получают похожие векторы.
+
+        dim: размерность вектора.
+        ngram: длина символьных n-грамм.
+        """
+        self.dim = dim
+        self.ngram = ngram
+        self.name = f"hashing:{dim}:{ngram}"
+
+    def _features(self, text):
+        for token in tokenize(text):
+            yield token
+            padded = f"<{token}>"
+            for i in range(max(len(padded) - self.ngram + 1, 0)):
+                yield padded[i:i + self.ngram]
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            # blake2b стабилен между процессами, в отличие от встроенного hash()
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[digest % self.dim] += 1.0 if (digest >> 63) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, path, namespace):
+        """
+        Постоянный кэш "текст -> вектор" в SQLite перед любым бэкендом эмбеддингов.
+
+        Кэш общий для всех процессов, использующих один файл, поэтому повторяющиеся
+        фрагменты (например, в разных версиях одного требования) не эмбеддятся повторно.
+
+        embeddings: бэкенд эмбеддингов.
+        path: путь к файлу кэша.
+        namespace: идентификатор модели, векторы разных моделей не смешиваются.
+        """
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def _load(self, keys):
+        found = {}
+        keys = list(keys)
+        # SQLite ограничивает число параметров в одном запросе
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+            for key, blob in rows:
+                found[key] = array.array("f", blob).tolist()
+        return found
+
+    def _store(self, items):
+        rows = [(key, array.array("f", vector).tobytes()) for key, vector in items]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        cached = self._load(set(keys))
+        # Эмбеддим только отсутствующие в кэше тексты, каждый уникальный текст - один раз
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._store(computed.items())
+            cached.update(computed)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(text)
+        cached = self._load([key])
+        if key in cached:
+            return cached[key]
+        vector = self.embeddings.embed_query(text)
+        self._store([(key, vector)])
+        return vector
+
+
+def make_embeddings(backend=None, cache_path=None):
+    """
+    Создает бэкенд эмбеддингов с кэшем на диске.
+
+    backend: "gigachat", "local" или готовый объект Embeddings. По умолчанию берется из RAG_EMBEDDINGS или "gigachat".
+    cache_path: путь к файлу кэша. По умолчанию берется из RAG_EMBEDDING_CACHE или ".embedding_cache.sqlite";
+                пустая строка отключает кэш.
+    return: объект Embeddings.
+    """
+    backend = backend or os.environ.get("RAG_EMBEDDINGS", "gigachat")
+    if cache_path is None:
+        cache_path = os.environ.get("RAG_EMBEDDING_CACHE", ".embedding_cache.sqlite")
+
+    if isinstance(backend, Embeddings):
+        embeddings = backend
+        namespace = getattr(backend, "name", None) or type(backend).__name__
+    elif backend == "gigachat":
+        embeddings = GigaChatEmbeddings(
             one_by_one_mode=True,
             credentials=credentials, 
             verify_ssl_certs=False
         )
-        
-        self.doc_store = Qdrant.from_documents(
-            docs,
-            self.embeddings,
-            location=":memory:",
-            collection_name="docs",
-        )
-        
-        self.rag = self.doc_store.as_retriever(search_kwargs={'k': top_k})
+        namespace = f"gigachat:{embeddings.model}"
+    elif backend == "local":
+        embeddings = HashingEmbeddings()
+        namespace = embeddings.name
+    else:
+        raise ValueError(f"Неизвестный бэкенд эмбеддингов: {backend}. Допустимые значения: gigachat, local")
+
+    if not cache_path:
+        return embeddings
+    return CachedEmbeddings(embeddings, cache_path, namespace)
+
+
+class Rag:
+    MODES = ("vector", "hybrid", "lexical")
+
+    def __init__(self, top_k=3, chunk_size=512, chunk_overlap=50, mode=None, alpha=0.5,
+                 embedding_backend=None, cache_path=None):
+        """
+        Поиск справочных данных по корпусу типовых ошибок в требованиях.
+
+        top_k: количество документов на один фрагмент запроса.
+        chunk_size: размер фрагмента запроса.
+        chunk_overlap: перекрытие фрагментов запроса.
+        mode: "vector" - только эмбеддинги, "hybrid" - BM25 + эмбеддинги,
+              "lexical" - только BM25, без обращений к API. По умолчанию берется из RAG_MODE или "hybrid".
+        alpha: вес векторной оценки в гибридном режиме (вес BM25 равен 1 - alpha).
+        embedding_backend: "gigachat", "local" или объект Embeddings (см. make_embeddings).
+        cache_path: путь к общему кэшу эмбеддингов (см. make_embeddings).
+        """
+        self.mode = mode or os.environ.get("RAG_MODE", "hybrid")
+        if self.mode not in self.MODES:
+            raise ValueError(f"Неизвестный режим RAG: {self.mode}. Допустимые значения: {', '.join(self.MODES)}")
+        self.top_k = top_k
+        self.alpha = alpha
+        self.docs = docs
+
+        self.bm25 = BM25Index(self.docs) if self.mode != "vector" else None
+
+        self.embeddings = None
+        self.doc_store = None
+        self.rag = None
+        if self.mode != "lexical":
+            self.embeddings = make_embeddings(embedding_backend, cache_path)
+            
+            self.doc_store = Qdrant.from_documents(
+                self.docs,
+                self.embeddings,
+                location=":memory:",
+                collection_name="docs",
+            )
+            
+            self.rag = self.doc_store.as_retriever(search_kwargs={'k': top_k})
 
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap
         )
 
+    def search(self, text):
+        """
+        Поиск документов для одного фрагмента запроса в выбранном режиме.
+
+        text: фрагмент запроса.
+        return: список Document, отсортированный по убыванию релевантности.
+        """
+        if self.mode == "vector":
+            return self.rag.invoke(text)
+        if self.mode == "lexical":
+            return [doc for doc, _ in self.bm25.search(text, self.top_k)]
+
+        # Гибридный режим: объединяем нормализованные оценки BM25 и косинусной близости
+        candidates = 2 * self.top_k
+        lexical = {doc.page_content: score for doc, score in self.bm25.search(text, candidates)}
+        vector = {doc.page_content: score for doc, score in self.doc_store.similarity_search_with_score(text, k=candidates)}
+        lexical, vector = _normalize_scores(lexical), _normalize_scores(vector)
+        fused = {
+            content: self.alpha * vector.get(content, 0.0) + (1 - self.alpha) * lexical.get(content, 0.0)
+            for content in lexical.keys() | vector.keys()
+        }
+        best = sorted(fused, key=fused.get, reverse=True)[:self.top_k]
+        return [Document(page_content=content) for content in best]
+
     def get_data(self, text) -> str:
         chunks = self.text_splitter.split_text(text)
 
         responses = []
         for chunk in chunks:
-            response = self.rag.invoke(chunk)
+            response = self.search(chunk)
             responses.extend(response)
 
         if not responses:
@@ -0,0 +1,454 @@
+import os
+import sys
+import json
+import gzip
+import glob
+import time
+import uuid
+import asyncio
+import difflib
+import hashlib
+import argparse
+import threading
+from collections import Counter, defaultdict, deque
+
+from langchain_core.messages import AIMessage
+
+# === Цены GigaChat API, рублей за 1000 токенов ===
+# Примерные значения, актуальные цены - в тарифах GigaChat API
+MODEL_PRICES = {
+    "GigaChat": 0.2,
+    "GigaChat-Pro": 1.5,
+    "GigaChat-Max": 1.95,
+}
+
+
+def prompt_text(prompt):
+    """Текст промпта: строка или содержимое сообщений, разделенное ролями."""
+    if isinstance(prompt, (list, tuple)):
+        return "\n".join(f"[{message.type}]\n{message.content}" for message in prompt)
+    return str(prompt)
+
+
+def prompt_hash(prompt):
+    """Хэш промпта: по нему при воспроизведении определяется, изменился ли промпт."""
+    return hashlib.sha256(prompt_text(prompt).encode("utf-8")).hexdigest()[:16]
+
+
+def token_usage(response):
+    """
+    Извлекает количество токенов из ответа модели.
+
+    return: словарь {"input_tokens", "output_tokens"} или пустой словарь.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        return {"input_tokens": usage.get("input_tokens", 0), "output_tokens": usage.get("output_tokens", 0)}
+    usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    if usage:
+        return {"input_tokens": usage.get("prompt_tokens", 0), "output_tokens": usage.get("completion_tokens", 0)}
+    return {}
+
+
+def usage_cost(model, usage):
+    """Стоимость запроса в рублях по MODEL_PRICES, 0 для неизвестной модели."""
+    tokens = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+    return tokens * MODEL_PRICES.get(model, 0.0) / 1000
+
+
+def _response_text(response):
+    return response.content if hasattr(response, "content") else str(response)
+
+
+class SessionRecorder:
+    def __init__(self, path=None):
+        """
+        Запись сессии: все запросы агентов к модели, обращения к RAG и Confluence.
+
+        Сессия сохраняется в gzip JSON Lines: первая строка - входные данные, далее события,
+        последняя строка - результаты. Вместо промптов хранятся их хэши, ответы хранятся целиком.
+
+        path: файл сессии или директория (имя файла генерируется). None - не сохранять.
+        """
+        self.path = path
+        self.events = []
+        self.started_at = time.time()
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def _reserve(self, kind, stage):
+        # Номер вызова выдается при его начале, а не при завершении: так же, как при воспроизведении,
+        # поэтому параллельные вызовы одного этапа получают номера в порядке запуска
+        with self._lock:
+            index = self._counters[(kind, stage)]
+            self._counters[(kind, stage)] += 1
+            return index
+
+    def _add(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def _record_llm(self, index, stage, model, prompt, response, latency, error=None, timeout=False):
+        usage = token_usage(response) if response is not None else {}
+        model_name = getattr(model, "model", None)
+        event = {
+            "type": "llm",
+            "stage": stage,
+            "index": index,
+            "model": model_name,
+            "prompt_sha": prompt_hash(prompt),
+            "prompt_chars": len(prompt_text(prompt)),
+            "response": _response_text(response) if response is not None else None,
+            "latency": latency,
+            "usage": usage,
+            "cost": usage_cost(model_name, usage),
+        }
+        if error is not None:
+            # Неудачная попытка: при воспроизведении ошибка возникает снова, и агент повторяет запрос
+            event.update(error=error, timeout=timeout)
+        self._add(event)
+
+    def invoke(self, stage, model, prompt):
+        """Синхронный запрос агента stage к модели с записью, неудачные попытки тоже записываются."""
+        index = self._reserve("llm", stage)
+        start = time.perf_counter()
+        try:
+            response = model.invoke(prompt)
+        except Exception as e:
+            self._record_llm(index, stage, model, prompt, None, time.perf_counter() - start, error=repr(e))
+            raise
+        self._record_llm(index, stage, model, prompt, response, time.perf_counter() - start)
+        return response
+
+    async def ainvoke(self, stage, model, prompt):
+        """Асинхронный запрос агента stage к модели с записью, неудачные попытки и таймауты тоже записываются."""
+        index = self._reserve("llm", stage)
+        start = time.perf_counter()
+        try:
+            response = await model.ainvoke(prompt)
+        except asyncio.CancelledError:
+            # Таймаут asyncio.wait_for отменяет запрос, при воспроизведении он повторяется как TimeoutError
+            self._record_llm(index, stage, model, prompt, None, time.perf_counter() - start,
+                             error="TimeoutError()", timeout=True)
+            raise
+        except Exception as e:
+            self._record_llm(index, stage, model, prompt, None, time.perf_counter() - start, error=repr(e))
+            raise
+        self._record_llm(index, stage, model, prompt, response, time.perf_counter() - start)
+        return response
+
+    def call(self, stage, func, request):
+        """
+        Вызов внешнего источника данных (RAG, Confluence) с записью.
+
+        stage: название источника.
+        func: функция одного аргумента.
+        request: аргумент функции.
+        """
+        index = self._reserve("io", stage)
+        start = time.perf_counter()
+        response = func(request)
+        self._add({
+            "type": "io",
+            "stage": stage,
+            "index": index,
+            "request": request,
+            "response": response,
+            "latency": time.perf_counter() - start,
+        })
+        return response
+
+    def finish(self, workflow, results, project=None):
+        """
+        Сохраняет сессию в файл.
+
+        workflow: Main_Workflow, из него берутся входные данные и настройки этапов.
+        results: результаты review или review_project.
+        project: аргументы review_project для проверки проекта, None - обычная проверка.
+        return: путь к файлу сессии или None.
+        """
+        if not self.path:
+            return None
+        path = self.path
+        if os.path.isdir(path):
+            path = os.path.join(path, f"session_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jsonl.gz")
+        header = {
+            "type": "session",
+            "version": 2,
+            "created_at": self.started_at,
+            "wall_time": time.time() - self.started_at,
+            "project_requirements": workflow.project_requirements,
+            "project_code": workflow.project_code,
+            "stage_modes": workflow.stage_modes,
+            "reconcile": workflow.reconcile,
+            "project": project,
+            # Выбор моделей: явная модель для всех этапов или маршрутизация по уровням с эскалацией
+            "routing": workflow.router is not None,
+            "model": getattr(workflow.gigachat_model, "model", None),
+            "model_tiers": workflow.router.tiers if workflow.router is not None else None,
+            "stage_tiers": workflow.stage_tiers,
+            "retry_delay": workflow.retry_delay,
+        }
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            for record in [header, *self.events, {"type": "results", "results": results}]:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return path
+
+
+def load_session(path):
+    """
+    Читает записанную сессию.
+
+    return: кортеж (входные данные, события, результаты).
+    """
+    header, events, results = None, [], {}
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            if record["type"] == "session":
+                header = record
+            elif record["type"] == "results":
+                results = record["results"]
+            else:
+                events.append(record)
+    return header, events, results
+
+
+class ReplayModel:
+    def __init__(self, model):
+        """Модель при воспроизведении: ответы берутся из записи, используется только название модели."""
+        self.model = model
+
+
+def _request_key(request):
+    return json.dumps(request, ensure_ascii=False, sort_keys=True)
+
+
+class ReplaySession:
+    def __init__(self, events, speed=0):
+        """
+        Воспроизведение записанной сессии без обращений к API.
+
+        Имеет тот же интерфейс, что и SessionRecorder. Ответы модели выдаются по названию этапа и хэшу промпта
+        в порядке записи, так как параллельные вызовы одного этапа при воспроизведении могут идти в другом порядке.
+        Если промпт изменился, выдается первый неиспользованный ответ этапа. Ответы источников данных
+        сопоставляются по запросу, так как страницы Confluence загружаются параллельно в разном порядке.
+
+        events: события записанной сессии.
+        speed: если больше 0, каждый вызов ждет записанную задержку, деленную на speed,
+               чтобы оценить время всего конвейера с учетом параллельных этапов.
+        """
+        self.speed = speed
+        self.recorded = {(e["type"], e["stage"], e["index"]): e for e in events}
+        self.io = defaultdict(deque)
+        self.llm = defaultdict(deque)
+        self.llm_order = defaultdict(list)
+        for event in sorted(events, key=lambda e: e["index"]):
+            if event["type"] == "io":
+                self.io[(event["stage"], _request_key(event["request"]))].append(event)
+            else:
+                self.llm[(event["stage"], event["prompt_sha"])].append(event)
+                self.llm_order[event["stage"]].append(event)
+        self.replayed = []
+        self._used = set()
+        self._lock = threading.Lock()
+
+    def _next(self, stage, prompt):
+        with self._lock:
+            queue = self.llm[(stage, prompt_hash(prompt))]
+            while queue and (stage, queue[0]["index"]) in self._used:
+                queue.popleft()
+            if queue:
+                event, changed = queue.popleft(), False
+            else:
+                event = next((e for e in self.llm_order[stage] if (stage, e["index"]) not in self._used), None)
+                changed = event is not None
+            if event is not None:
+                self._used.add((stage, event["index"]))
+            self.replayed.append({
+                "type": "llm", "stage": stage, "index": event["index"] if event else None,
+                "missing": event is None, "prompt_changed": changed, "prompt_chars": len(prompt_text(prompt)),
+            })
+        return event
+
+    def _delay(self, event):
+        return event["latency"] / self.speed if event and self.speed > 0 else 0
+
+    @staticmethod
+    def _response(event):
+        if event is None:
+            return AIMessage(content="")
+        if event.get("error") is not None:
+            if event.get("timeout"):
+                raise asyncio.TimeoutError(f"Записанный таймаут запроса {event['stage']}")
+            raise RuntimeError(f"Записанная ошибка запроса {event['stage']}: {event['error']}")
+        return AIMessage(content=event["response"])
+
+    def invoke(self, stage, model, prompt):
+        event = self._next(stage, prompt)
+        time.sleep(self._delay(event))
+        return self._response(event)
+
+    async def ainvoke(self, stage, model, prompt):
+        event = self._next(stage, prompt)
+        await asyncio.sleep(self._delay(event))
+        return self._response(event)
+
+    def call(self, stage, func, request):
+        with self._lock:
+            queue = self.io[(stage, _request_key(request))]
+            event = queue.popleft() if queue else None
+            self.replayed.append({"type": "io", "stage": stage, "index": event["index"] if event else None,
+                                  "missing": event is None})
+        time.sleep(self._delay(event))
+        return event["response"] if event else ""
+
+    def finish(self, workflow, results, project=None):
+        return None
+
+
+def _result_text(value):
+    # Отчеты по модулям проверки проекта - словарь, они сравниваются в виде JSON
+    if isinstance(value, dict):
+        return json.dumps(value, ensure_ascii=False, indent=2)
+    return value or ""
+
+
+def replay_session(path, speed=0):
+    """
+    Повторно выполняет конвейер Main_Workflow.areview или areview_project по записанной сессии.
+    Для проверки проекта код читается из записанного пути code_path.
+    Модели выбираются так же, как при записи: явная модель или маршрутизация с теми же уровнями этапов.
+
+    path: файл сессии.
+    speed: ускорение записанных задержек (0 - без задержек).
+    return: словарь с метриками по этапам и расхождениями результатов.
+    """
+    from agent import Main_Workflow, ModelRouter, MODEL_TIERS
+    from rag import Rag
+
+    header, events, recorded_results = load_session(path)
+    replay = ReplaySession(events, speed=speed)
+    if header.get("routing", True):
+        models = dict(
+            router=ModelRouter(header.get("model_tiers") or MODEL_TIERS, lambda model, temperature, top_p: ReplayModel(model)),
+            stage_tiers=header.get("stage_tiers"),
+        )
+    else:
+        models = dict(gigachat_model=ReplayModel(header.get("model")))
+    # Паузы между повторами после записанных ошибок ускоряются так же, как задержки запросов
+    retry_delay = header.get("retry_delay", 20) / speed if speed > 0 else 0
+    workflow = Main_Workflow(
+        header["project_requirements"],
+        header["project_code"],
+        retry_delay=retry_delay,
+        stage_modes=header.get("stage_modes"),
+        reconcile=header.get("reconcile", False),
+        recorder=replay,
+        **models,
+    )
+    start = time.perf_counter()
+    # Rag без эмбеддингов: ответы RAG все равно берутся из записи
+    project = header.get("project")
+    if project:
+        results = asyncio.run(workflow.areview_project(rag=Rag(mode="lexical"), **project))
+    else:
+        results = asyncio.run(workflow.areview(rag=Rag(mode="lexical")))
+    replay_wall = time.perf_counter() - start
+
+    # Записанный и воспроизведенный запуски по этапам. Задержка и стоимость воспроизведенного вызова известны,
+    # только если для его промпта есть запись; остальные вызовы (новые или с измененным промптом) - в "unknown"
+    stages = defaultdict(lambda: {
+        "calls": 0, "latency": 0.0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0, "prompt_chars": 0,
+        "replay_calls": 0, "replay_latency": 0.0, "replay_cost": 0.0, "replay_prompt_chars": 0, "unknown": 0,
+    })
+    for event in events:
+        stats = stages[event["stage"]]
+        stats["calls"] += 1
+        stats["latency"] += event["latency"]
+        stats["input_tokens"] += event.get("usage", {}).get("input_tokens", 0)
+        stats["output_tokens"] += event.get("usage", {}).get("output_tokens", 0)
+        stats["cost"] += event.get("cost", 0.0)
+        stats["prompt_chars"] += event.get("prompt_chars", 0)
+    for replayed in replay.replayed:
+        stats = stages[replayed["stage"]]
+        stats["replay_calls"] += 1
+        stats["replay_prompt_chars"] += replayed.get("prompt_chars", 0)
+        if replayed["missing"] or replayed.get("prompt_changed"):
+            stats["unknown"] += 1
+        else:
+            event = replay.recorded[(replayed["type"], replayed["stage"], replayed["index"])]
+            stats["replay_latency"] += event["latency"]
+            stats["replay_cost"] += event.get("cost", 0.0)
+
+    replayed_keys = {(e["type"], e["stage"], e["index"]) for e in replay.replayed}
+    diffs = {}
+    for key in sorted(recorded_results.keys() | results.keys()):
+        before, after = _result_text(recorded_results.get(key)), _result_text(results.get(key))
+        if before != after:
+            diffs[key] = "\n".join(difflib.unified_diff(
+                before.splitlines(), after.splitlines(), "записано", "воспроизведено", lineterm=""))
+    return {
+        "path": path,
+        "recorded_wall": header.get("wall_time"),
+        "replay_wall": replay_wall,
+        "stages": dict(stages),
+        "prompt_changes": sorted({e["stage"] for e in replay.replayed if e.get("prompt_changed")}),
+        "missing": sorted({e["stage"] for e in replay.replayed if e["missing"]}),
+        "unused": sorted({stage for kind, stage, index in replay.recorded if (kind, stage, index) not in replayed_keys}),
+        "diffs": diffs,
+    }
+
+
+def print_report(reports, show_diff=False):
+    """Печатает сводку по этапам для всех сессий и расхождения результатов."""
+    totals = defaultdict(lambda: Counter())
+    for report in reports:
+        for stage, stats in report["stages"].items():
+            totals[stage].update(stats)
+
+    # Записанное значение / воспроизведенное, "+?" - есть вызовы с неизвестной стоимостью; токены - только записанные
+    print(f"{'Этап':<36}{'вызовов':>12}{'промпт, симв.':>22}{'задержка, с':>18}{'стоимость, ₽':>20}{'токены записи':>18}")
+    for stage, stats in sorted(totals.items(), key=lambda item: -item[1]["latency"]):
+        unknown = "+?" if stats["unknown"] else ""
+        calls = f"{stats['calls']}/{stats['replay_calls']}"
+        prompt_chars = f"{stats['prompt_chars']}/{stats['replay_prompt_chars']}"
+        latency = f"{stats['latency']:.2f}/{stats['replay_latency']:.2f}{unknown}"
+        cost = f"{stats['cost']:.2f}/{stats['replay_cost']:.2f}{unknown}"
+        tokens = f"{stats['input_tokens']}/{stats['output_tokens']}"
+        print(f"{stage:<36}{calls:>12}{prompt_chars:>22}{latency:>18}{cost:>20}{tokens:>18}")
+
+    for report in reports:
+        recorded_wall = report["recorded_wall"]
+        print(f"\n{report['path']}: записано {recorded_wall or 0:.1f} с, воспроизведено {report['replay_wall']:.2f} с")
+        for title, key in (("Изменились промпты", "prompt_changes"), ("Нет записанного ответа", "missing"),
+                           ("Не использованы записи", "unused")):
+            if report[key]:
+                print(f"  {title}: {', '.join(report[key])}")
+        for key, diff in report["diffs"].items():
+            print(f"  Результат отличается: {key}")
+            if show_diff:
+                print(diff)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных сессий и сравнение результатов.")
+    parser.add_argument("paths", nargs="+", help="файлы сессий (*.jsonl.gz) или директории с ними")
+    parser.add_argument("--speed", type=float, default=0, help="ускорение записанных задержек, 0 - без задержек")
+    parser.add_argument("--diff", action="store_true", help="показать расхождения результатов")
+    parser.add_argument("--json", help="сохранить отчет в JSON")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.paths:
+        paths.extend(sorted(glob.glob(os.path.join(path, "*.jsonl.gz"))) if os.path.isdir(path) else [path])
+    reports = [replay_session(path, speed=args.speed) for path in paths]
+    print_report(reports, show_diff=args.diff)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(reports, file, ensure_ascii=False, indent=2)
+    return 1 if any(report["diffs"] for report in reports) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Literal
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from agent import Main_Workflow, model_router
+from rag import Rag
+from prompts import prompt_stats
+
+# === Настройки сервиса ===
+WORKERS = int(os.environ.get("AGENT_WORKERS", 4))
+HOST = os.environ.get("AGENT_HOST", "127.0.0.1")
+PORT = int(os.environ.get("AGENT_PORT", 8000))
+# Файлы для проверки читаются только из этой директории
+FILES_DIR = os.path.abspath(os.environ.get("AGENT_FILES_DIR", "."))
+# Завершенные задания хранятся не дольше JOB_TTL секунд и не больше MAX_JOBS штук
+JOB_TTL = int(os.environ.get("AGENT_JOB_TTL", 3600))
+MAX_JOBS = int(os.environ.get("AGENT_MAX_JOBS", 1000))
+
+
+class JobRequest(BaseModel):
+    """
+    Задание на проверку. Для требований и для кода указывается ровно один источник:
+    текст, имя файла в AGENT_FILES_DIR или идентификатор страницы Confluence.
+    Для проверки проекта вместо них указываются корневая страница дерева требований (requirements_tree_page_id)
+    и директория или zip-архив с кодом в AGENT_FILES_DIR (code_dir).
+    stage_modes и reconcile передаются в Main_Workflow.
+    """
+    requirements: str | None = None
+    requirements_file: str | None = None
+    requirements_page_id: str | None = None
+    requirements_tree_page_id: str | None = None
+    code: str | None = None
+    code_file: str | None = None
+    code_page_id: str | None = None
+    code_dir: str | None = None
+    stage_modes: dict[Literal["quality_evaluator", "summarizer_agent"], Literal["final", "speculative"]] | None = None
+    reconcile: bool = False
+
+
+class Job:
+    def __init__(self, request):
+        """
+        Задание на проверку и его состояние.
+
+        request: JobRequest.
+        """
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.status = "queued"
+        self.results = None
+        self.stats = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # История событий для SSE, новые подписчики получают ее целиком.
+        # Отчеты в историю не попадают, они добавляются к событию "done" при отправке
+        self.events = []
+        self.changed = asyncio.Condition()
+
+    async def publish(self, status, **data):
+        """Меняет статус задания и уведомляет подписчиков."""
+        self.status = status
+        async with self.changed:
+            self.events.append({"status": status, **data})
+            self.changed.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "results": self.results,
+            "stages": self.stats.summary() if self.stats else None,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+def _resolve_path(file_name, kind):
+    """Путь к файлу или директории внутри AGENT_FILES_DIR."""
+    path = os.path.abspath(os.path.join(FILES_DIR, file_name))
+    if os.path.commonpath([path, FILES_DIR]) != FILES_DIR:
+        raise ValueError(f"Файл с {kind} вне директории {FILES_DIR}: {file_name}")
+    if not os.path.exists(path):
+        raise ValueError(f"Файл с {kind} не найден: {file_name}")
+    return path
+
+
+def _read_source(text, file_name, page_id, kind, load_page):
+    """
+    Считывает требования или код из указанного источника.
+
+    kind: название источника для сообщений об ошибках.
+    load_page: функция загрузки страницы Confluence по идентификатору.
+    return: текст.
+    """
+    if text is not None:
+        return text
+    if file_name is not None:
+        path = _resolve_path(file_name, kind)
+        with open(path, 'r', encoding='utf-8') as file:
+            return file.read()
+    return load_page(page_id)
+
+
+class JobQueue:
+    def __init__(self, workers, router, rag, ttl=JOB_TTL, max_jobs=MAX_JOBS):
+        """
+        Очередь заданий с пулом воркеров.
+
+        Воркеры работают в одном event loop и используют общие модель, RAG
+        и ограничение числа одновременных запросов к модели (LLM_CONCURRENCY).
+
+        workers: количество воркеров.
+        router: ModelRouter, выбирающий модель для каждого этапа.
+        rag: общий объект Rag.
+        ttl: время хранения завершенного задания в секундах.
+        max_jobs: максимальное количество хранимых заданий, при превышении удаляются самые старые завершенные.
+        """
+        self.workers = workers
+        self.router = router
+        self.rag = rag
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.queue = asyncio.Queue()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def prune(self):
+        """Удаляет завершенные задания старше ttl и самые старые завершенные сверх max_jobs."""
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and now - job.finished_at > self.ttl:
+                del self.jobs[job_id]
+        excess = len(self.jobs) - self.max_jobs
+        if excess > 0:
+            finished = sorted((job for job in self.jobs.values() if job.finished), key=lambda job: job.finished_at)
+            for job in finished[:excess]:
+                del self.jobs[job.id]
+
+    async def submit(self, request):
+        """Ставит задание в очередь и возвращает его."""
+        self.prune()
+        job = Job(request)
+        self.jobs[job.id] = job
+        await job.publish("queued", position=self.queue.qsize() + 1)
+        await self.queue.put(job)
+        return job
+
+    async def _worker(self, n):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._process(job)
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, job):
+        job.started_at = time.time()
+        await job.publish("running")
+        request = job.request
+        try:
+            workflow = Main_Workflow(
+                router=self.router,
+                stage_modes=request.stage_modes,
+                reconcile=request.reconcile,
+            )
+            job.stats = workflow.stats
+            if request.code_dir is not None:
+                # Проверка проекта: дерево страниц требований и директория или архив с кодом
+                if request.requirements_tree_page_id is None:
+                    workflow.project_requirements = await asyncio.to_thread(
+                        _read_source, request.requirements, request.requirements_file,
+                        request.requirements_page_id, "требованиями", workflow.load_page)
+                job.results = await workflow.areview_project(
+                    _resolve_path(request.code_dir, "кодом"),
+                    requirements_page_id=request.requirements_tree_page_id,
+                    rag=self.rag,
+                )
+            else:
+                # Файлы и Confluence читаются в потоках, чтобы не блокировать остальных воркеров
+                workflow.project_requirements, workflow.project_code = await asyncio.gather(
+                    asyncio.to_thread(_read_source, request.requirements, request.requirements_file,
+                                      request.requirements_page_id, "требованиями", workflow.load_page),
+                    asyncio.to_thread(_read_source, request.code, request.code_file,
+                                      request.code_page_id, "кодом", workflow.load_page),
+                )
+                job.results = await workflow.areview(rag=self.rag)
+        except Exception as e:
+            logging.exception(f"Ошибка при обработке задания {job.id}")
+            job.error = f"{e.__class__.__name__}: {e}"
+            job.finished_at = time.time()
+            await job.publish("failed", error=job.error)
+        else:
+            job.finished_at = time.time()
+            await job.publish("done")
+
+    async def stream(self, job):
+        """
+        Поток событий задания в формате server-sent events.
+
+        Завершается после статуса "done" или "failed".
+        """
+        sent = 0
+        while True:
+            async with job.changed:
+                await job.changed.wait_for(lambda: len(job.events) > sent)
+                events = job.events[sent:]
+            sent += len(events)
+            for event in events:
+                if event["status"] == "done":
+                    event = dict(event, results=job.results)
+                yield f"event: {event['status']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                if event["status"] in ("done", "failed"):
+                    return
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.jobs = JobQueue(WORKERS, model_router, Rag())
+    app.state.jobs.start()
+    yield
+    await app.state.jobs.stop()
+
+
+app = FastAPI(title="products-ai-agent", lifespan=lifespan)
+
+
+def _get_job(job_id):
+    job = app.state.jobs.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: JobRequest):
+    """Создает задание на проверку требований и кода."""
+    sources = {
+        "requirements": ["requirements", "requirements_file", "requirements_page_id", "requirements_tree_page_id"],
+        "code": ["code", "code_file", "code_page_id", "code_dir"],
+    }
+    for kind, fields in sources.items():
+        if sum(getattr(request, field) is not None for field in fields) != 1:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Укажите ровно один источник: {', '.join(fields)}",
+            )
+    if request.requirements_tree_page_id is not None and request.code_dir is None:
+        raise HTTPException(status_code=422, detail="Дерево требований проверяется только вместе с code_dir")
+    job = await app.state.jobs.submit(request)
+    return {"id": job.id, "status": job.status}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Возвращает статус задания и отчеты, если проверка завершена."""
+    return _get_job(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Поток статусов задания (server-sent events), последнее событие содержит отчеты."""
+    job = _get_job(job_id)
+    return StreamingResponse(app.state.jobs.stream(job), media_type="text/event-stream")
+
+
+@app.get("/stats")
+async def stats():
+    """Статистика промптов: переиспользование стабильного префикса."""
+    return prompt_stats.summary()
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=HOST, port=PORT)